@@ -0,0 +1,164 @@
+#!/bin/env python3
+
+import json, math, random
+
+from urllib.parse import urlencode
+
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+
+AREA_VOCABULARY_ID = '7'
+
+SESSION_COOKIE_NAME = b'SESSfake'
+SESSION_COOKIE_VALUE = b'fake-session'
+
+# RestWS serves 100 entities per page unless asked for fewer
+DEFAULT_PAGE_SIZE = 100
+
+# Mix of the geometry types of generated areas
+POLYGON_AREA_SHARE = 0.8
+LINE_STRING_AREA_SHARE = 0.1
+
+# Generated areas are scattered over roughly a 10km square
+ORIGIN_LON_LAT = (-122.5, 45.5)
+AREA_SPREAD_DEGREES = 0.1
+AREA_RADIUS_DEGREES = 0.0005
+
+
+class FakeFarmOsResource(resource.Resource):
+    """
+    Just enough of the RestWS api of a FarmOS site for the proxy to log in and page through its areas - with an
+    optional delay before every response to stand in for a real FarmOS under load. Any user name and password are
+    accepted but, like Drupal, only anonymous sessions may log in. Areas are generated deterministically from the seed.
+    """
+    isLeaf = True
+
+    def __init__(self, area_count, vertex_count, latency_seconds=0, page_size=DEFAULT_PAGE_SIZE, seed=0, clock=reactor):
+        super().__init__()
+        self._latency_seconds = latency_seconds
+        self._page_size = page_size
+        self._clock = clock
+
+        rng = random.Random(seed)
+
+        self._areas = [_generate_area(rng, tid, vertex_count) for tid in range(1, area_count + 1)]
+
+        # Areas are serialized once up front so serving a page is cheap compared to the proxy's work
+        self._area_json = [json.dumps(area) for area in self._areas]
+
+        self.request_count = 0
+        """Number of requests this fake FarmOS has received."""
+
+    def render(self, request):
+        self.request_count += 1
+
+        (response_code, body) = self._respond(request)
+
+        disconnected = []
+        request.notifyFinish().addErrback(lambda _failure: disconnected.append(True))
+
+        def finish():
+            if disconnected:
+                return
+
+            request.setResponseCode(response_code)
+            request.write(body)
+            request.finish()
+
+        if self._latency_seconds:
+            self._clock.callLater(self._latency_seconds, finish)
+        else:
+            finish()
+
+        return server.NOT_DONE_YET
+
+    def _respond(self, request):
+        path = request.path.decode('utf-8')
+
+        authenticated = request.getCookie(SESSION_COOKIE_NAME) == SESSION_COOKIE_VALUE
+
+        if path == '/user/login' and request.method == b'POST':
+            if authenticated:
+                return (403, b'')
+
+            request.addCookie(SESSION_COOKIE_NAME, SESSION_COOKIE_VALUE, path='/')
+            return (200, b'')
+
+        if not authenticated:
+            return (403, b'')
+
+        if path == '/restws/session/token':
+            return (200, b'fake-csrf-token')
+
+        if path == '/taxonomy_vocabulary.json':
+            return (200, json.dumps({'list': [{'vid': AREA_VOCABULARY_ID, 'machine_name': 'farm_areas'}]}).encode('utf-8'))
+
+        if path == '/taxonomy_term.json':
+            return (200, self._render_area_page({k.decode('utf-8'): [v.decode('utf-8') for v in vs] for (k, vs) in request.args.items()}))
+
+        return (404, b'')
+
+    def _render_area_page(self, args):
+        indices = range(len(self._areas))
+
+        tids = args.get('tid[]', None)
+
+        if not tids is None:
+            tids = set(tids)
+            indices = [index for index in indices if self._areas[index]['tid'] in tids]
+
+        if args.get('sort', None) == ['changed']:
+            indices = sorted(indices, key=lambda index: int(self._areas[index]['changed']), reverse=(args.get('direction', None) == ['DESC']))
+
+        limit = min(int(args.get('limit', [self._page_size])[0]), self._page_size)
+        page = int(args.get('page', ['0'])[0])
+
+        last_page = max(0, math.ceil(len(indices) / limit) - 1)
+
+        page_area_json = ','.join(self._area_json[index] for index in indices[page * limit:(page + 1) * limit])
+
+        last_args = {k: v[0] for (k, v) in args.items() if k != 'page'}
+        last_args['page'] = last_page
+
+        links = json.dumps({
+            'self': '/taxonomy_term.json?' + urlencode(dict(last_args, page=page)),
+            'first': '/taxonomy_term.json?' + urlencode(dict(last_args, page=0)),
+            'last': '/taxonomy_term.json?' + urlencode(last_args),
+        })
+
+        # The list is spliced together from the pre-serialized areas - followed by the links object's members
+        return ('{"list": [' + page_area_json + '], ' + links[1:]).encode('utf-8')
+
+
+def _generate_area(rng, tid, vertex_count):
+    center_x = ORIGIN_LON_LAT[0] + rng.uniform(0, AREA_SPREAD_DEGREES)
+    center_y = ORIGIN_LON_LAT[1] + rng.uniform(0, AREA_SPREAD_DEGREES)
+
+    def vertices(count, closed):
+        points = [(center_x + AREA_RADIUS_DEGREES * math.cos(2 * math.pi * i / count) * rng.uniform(0.7, 1),
+                   center_y + AREA_RADIUS_DEGREES * math.sin(2 * math.pi * i / count) * rng.uniform(0.7, 1)) for i in range(count)]
+
+        if closed:
+            points.append(points[0])
+
+        return ', '.join('{:.7f} {:.7f}'.format(x, y) for (x, y) in points)
+
+    kind = rng.random()
+
+    if kind < POLYGON_AREA_SHARE:
+        (geo_type, geom) = ('polygon', 'POLYGON (({}))'.format(vertices(max(3, vertex_count), closed=True)))
+    elif kind < POLYGON_AREA_SHARE + LINE_STRING_AREA_SHARE:
+        (geo_type, geom) = ('linestring', 'LINESTRING ({})'.format(vertices(max(2, vertex_count), closed=False)))
+    else:
+        (geo_type, geom) = ('point', 'POINT ({:.7f} {:.7f})'.format(center_x, center_y))
+
+    return {
+        'tid': str(tid),
+        'name': "Area {}".format(tid),
+        'description': "",
+        'area_type': rng.choice(('field', 'bed', 'building', 'paddock')),
+        'changed': str(1600000000 + tid),
+        'vocabulary': {'id': AREA_VOCABULARY_ID, 'resource': 'taxonomy_vocabulary'},
+        'geofield': [{'geo_type': geo_type, 'geom': geom}],
+    }
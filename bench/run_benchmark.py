@@ -0,0 +1,434 @@
+#!/bin/env python3
+
+import os, sys, json, time, shlex, socket, argparse, logging, platform, subprocess, warnings
+from base64 import b64encode
+
+from twisted.internet import defer, task, protocol, error
+from twisted.web import server
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+
+from lxml import etree
+
+from fake_farm_os import FakeFarmOsResource, DEFAULT_PAGE_SIZE
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FOSAFP_PATH = os.path.join(BENCH_DIR, '..', 'src', 'fosafp.py')
+DEFAULT_RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+DEFAULT_AREA_COUNTS = (1000, 10000, 100000)
+DEFAULT_VERTEX_COUNT = 16
+DEFAULT_CONCURRENCY = 4
+# Shorter than the proxy's area cache lifetime so the measured requests are served from the cache
+DEFAULT_DURATION_SECONDS = 20
+DEFAULT_REQUEST_TIMEOUT_SECONDS = 600
+
+PROXY_STARTUP_TIMEOUT_SECONDS = 60
+PROXY_STARTUP_POLL_SECONDS = 0.2
+PROXY_SHUTDOWN_TIMEOUT_SECONDS = 10
+
+WFS_NAMESPACE = "http://www.opengis.net/wfs"
+
+BENCH_USER = 'bench'
+BENCH_PASSWORD = 'bench'
+
+# Metrics compared between runs along with whether a higher value is an improvement
+COMPARED_METRICS = (
+    ('throughput_rps', True),
+    ('latency_ms_p50', False),
+    ('latency_ms_p99', False),
+    ('ttfb_ms_p50', False),
+    ('ttfb_ms_p99', False),
+)
+
+
+class _ProxyProcessProtocol(protocol.ProcessProtocol):
+    def __init__(self, log_file):
+        self._log_file = log_file
+        self.ended = defer.Deferred()
+
+    def outReceived(self, data):
+        self._log_file.write(data)
+
+    def errReceived(self, data):
+        self._log_file.write(data)
+
+    def processEnded(self, reason):
+        self._log_file.close()
+        self.ended.callback(reason.value)
+
+
+class ProxyProcess(object):
+    """
+    A fosafp proxy started as a separate process - so its memory use and CPU time are its own - with its output
+    written to a log file.
+    """
+
+    def __init__(self, reactor, farm_os_url, log_path, extra_args=()):
+        self._reactor = reactor
+        self.port = _free_port()
+        self.url = 'http://127.0.0.1:{}/'.format(self.port)
+        self.log_path = log_path
+
+        self._protocol = _ProxyProcessProtocol(open(log_path, 'wb'))
+
+        args = [sys.executable, FOSAFP_PATH,
+                '--farm-os-url={}'.format(farm_os_url),
+                '--proxy-spec=tcp:{}:interface=127.0.0.1'.format(self.port)] + list(extra_args)
+
+        self._process = reactor.spawnProcess(self._protocol, sys.executable, args, env=os.environ,
+                                             path=os.path.dirname(FOSAFP_PATH))
+
+    @defer.inlineCallbacks
+    def wait_until_listening(self, agent):
+        """
+        Fires once the proxy answers an unauthenticated GetCapabilities request - which doesn't involve FarmOS.
+        """
+        deadline = self._reactor.seconds() + PROXY_STARTUP_TIMEOUT_SECONDS
+
+        while True:
+            if self._protocol.ended.called:
+                raise Exception("The proxy exited during startup. See {}".format(self.log_path))
+
+            try:
+                response = yield agent.request(b'GET', _wfs_url(self.url, 'GetCapabilities'))
+                yield _read_body_no_warn(response)
+                return
+            except error.ConnectionRefusedError:
+                if self._reactor.seconds() > deadline:
+                    raise Exception("The proxy didn't start listening within {} seconds. See {}".format(PROXY_STARTUP_TIMEOUT_SECONDS, self.log_path))
+
+                yield task.deferLater(self._reactor, PROXY_STARTUP_POLL_SECONDS, lambda: None)
+
+    def peak_rss_bytes(self):
+        """
+        Returns the peak resident set size of the proxy process so far - or None where /proc isn't available. Only
+        covers the main process when the proxy runs multiple worker processes.
+        """
+        try:
+            with open('/proc/{}/status'.format(self._process.pid)) as status_file:
+                for line in status_file:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except (IOError, TypeError):
+            pass
+
+        return None
+
+    @defer.inlineCallbacks
+    def stop(self):
+        if self._protocol.ended.called:
+            return
+
+        self._process.signalProcess('TERM')
+
+        kill_call = self._reactor.callLater(PROXY_SHUTDOWN_TIMEOUT_SECONDS, self._kill)
+
+        yield self._protocol.ended
+
+        if kill_call.active():
+            kill_call.cancel()
+
+    def _kill(self):
+        try:
+            self._process.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+
+
+@defer.inlineCallbacks
+def run_scenario(reactor, args, area_count, run_name):
+    """
+    Benchmarks a proxy against a fake FarmOS with the given number of areas. The first GetCapabilities request
+    fetches all the areas from FarmOS and is reported separately from the following load of cached requests.
+    """
+    logging.info("Generating {} areas with {} vertices".format(area_count, args.vertex_count))
+
+    farm = FakeFarmOsResource(area_count, args.vertex_count, latency_seconds=args.farm_os_latency_ms / 1000,
+                              page_size=args.farm_os_page_size, seed=args.seed)
+    farm_port = reactor.listenTCP(0, server.Site(farm), interface='127.0.0.1')
+
+    pool = HTTPConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = args.concurrency
+
+    agent = Agent(reactor, pool=pool)
+
+    proxy = ProxyProcess(reactor, 'http://127.0.0.1:{}'.format(farm_port.getHost().port),
+                         os.path.join(args.output_dir, '{}-proxy-{}.log'.format(run_name, area_count)),
+                         extra_args=shlex.split(args.proxy_args))
+
+    try:
+        started = reactor.seconds()
+
+        yield proxy.wait_until_listening(agent)
+
+        startup_seconds = reactor.seconds() - started
+
+        headers = Headers({
+            'Authorization': [b'Basic ' + b64encode('{}:{}'.format(BENCH_USER, BENCH_PASSWORD).encode('utf-8'))],
+        })
+
+        logging.info("Fetching {} areas through the proxy".format(area_count))
+
+        (code, body, cold_ttfb, cold_latency) = yield _timed_get(reactor, agent, _wfs_url(proxy.url, 'GetCapabilities'), headers, args.request_timeout)
+
+        if code != 200:
+            raise Exception("Cold GetCapabilities request failed with {}: {!r}".format(code, body[:1000]))
+
+        cold_farm_os_requests = farm.request_count
+
+        request_mix = [('GetCapabilities', _wfs_url(proxy.url, 'GetCapabilities'))] + [
+            ('GetFeature ' + type_name, _wfs_url(proxy.url, 'GetFeature', TYPENAME=type_name)) for type_name in _feature_type_names(body)
+        ]
+
+        logging.info("Sending {} concurrent streams of requests for {} seconds".format(args.concurrency, args.duration))
+
+        load = yield _generate_load(reactor, agent, headers, request_mix, args.concurrency, args.duration, args.request_timeout)
+
+        return dict(load,
+            area_count=area_count,
+            startup_seconds=round(startup_seconds, 3),
+            cold_get_capabilities={
+                'latency_ms': round(cold_latency * 1000, 1),
+                'ttfb_ms': round(cold_ttfb * 1000, 1),
+                'bytes': len(body),
+                'farm_os_requests': cold_farm_os_requests,
+            },
+            farm_os_requests_under_load=farm.request_count - cold_farm_os_requests,
+            peak_rss_bytes=proxy.peak_rss_bytes(),
+        )
+    finally:
+        yield proxy.stop()
+        yield pool.closeCachedConnections()
+        yield farm_port.stopListening()
+
+
+@defer.inlineCallbacks
+def _generate_load(reactor, agent, headers, request_mix, concurrency, duration_seconds, request_timeout_seconds):
+    samples = {name: [] for (name, _url) in request_mix}
+    errors = {name: 0 for (name, _url) in request_mix}
+
+    deadline = reactor.seconds() + duration_seconds
+
+    @defer.inlineCallbacks
+    def request_stream(offset):
+        request_num = offset
+
+        while reactor.seconds() < deadline:
+            (name, url) = request_mix[request_num % len(request_mix)]
+            request_num += 1
+
+            try:
+                (code, body, ttfb, latency) = yield _timed_get(reactor, agent, url, headers, request_timeout_seconds)
+            except Exception:
+                logging.error(logging.traceback.format_exc())
+                errors[name] += 1
+                continue
+
+            if code != 200:
+                errors[name] += 1
+                continue
+
+            samples[name].append((latency, ttfb, len(body)))
+
+    started = reactor.seconds()
+
+    yield defer.gatherResults([request_stream(offset) for offset in range(concurrency)], consumeErrors=True)
+
+    elapsed = reactor.seconds() - started
+
+    def summarize(name_samples, name_errors):
+        latencies = sorted(sample[0] for sample in name_samples)
+        ttfbs = sorted(sample[1] for sample in name_samples)
+
+        return {
+            'requests': len(name_samples),
+            'errors': name_errors,
+            'throughput_rps': round(len(name_samples) / elapsed, 2),
+            'latency_ms_p50': _percentile_ms(latencies, 50),
+            'latency_ms_p99': _percentile_ms(latencies, 99),
+            'ttfb_ms_p50': _percentile_ms(ttfbs, 50),
+            'ttfb_ms_p99': _percentile_ms(ttfbs, 99),
+            'mean_bytes': round(sum(sample[2] for sample in name_samples) / len(name_samples)) if name_samples else None,
+        }
+
+    all_samples = [sample for name_samples in samples.values() for sample in name_samples]
+
+    return dict(summarize(all_samples, sum(errors.values())),
+        duration_seconds=round(elapsed, 3),
+        by_request={name: summarize(samples[name], errors[name]) for (name, _url) in request_mix},
+    )
+
+
+@defer.inlineCallbacks
+def _timed_get(reactor, agent, url, headers, timeout_seconds):
+    """
+    Returns (response code, body, seconds until the response headers arrived, seconds until the body was read).
+    """
+    started = reactor.seconds()
+
+    d = agent.request(b'GET', url, headers)
+    d.addTimeout(timeout_seconds, reactor)
+
+    response = yield d
+
+    first_byte_seconds = reactor.seconds() - started
+
+    body = yield _read_body_no_warn(response)
+
+    return (response.code, body, first_byte_seconds, reactor.seconds() - started)
+
+
+def _read_body_no_warn(response):
+    with warnings.catch_warnings():
+        # readBody has a buggy DeprecationWarning:
+        # https://twistedmatrix.com/trac/ticket/8227
+        warnings.simplefilter('ignore', category=DeprecationWarning)
+        return readBody(response)
+
+
+def _wfs_url(proxy_url, request_type, **params):
+    query = '&'.join('{}={}'.format(k, v) for (k, v) in dict(SERVICE='WFS', VERSION='1.0.0', REQUEST=request_type, **params).items())
+
+    return (proxy_url + '?' + query).encode('utf-8')
+
+
+def _feature_type_names(capabilities_body):
+    capabilities = etree.fromstring(capabilities_body)
+
+    return [name.text for name in capabilities.iterfind('.//{%s}FeatureType/{%s}Name' % (WFS_NAMESPACE, WFS_NAMESPACE))]
+
+
+def _percentile_ms(sorted_values, percentile):
+    if not sorted_values:
+        return None
+
+    # Nearest-rank percentile
+    index = max(0, -(-len(sorted_values) * percentile // 100) - 1)
+
+    return round(sorted_values[index] * 1000, 1)
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR, stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print_report(results):
+    for scenario in results['scenarios']:
+        print("\n{} areas: cold GetCapabilities {} ms, peak RSS {} MB".format(scenario['area_count'],
+            scenario['cold_get_capabilities']['latency_ms'],
+            None if scenario['peak_rss_bytes'] is None else round(scenario['peak_rss_bytes'] / (1024 * 1024), 1)))
+
+        print("  {:<44} {:>8} {:>7} {:>10} {:>10} {:>10} {:>10}".format('request', 'req/s', 'errors', 'p50 ms', 'p99 ms', 'ttfb p50', 'ttfb p99'))
+
+        for (name, summary) in [('all', scenario)] + sorted(scenario['by_request'].items()):
+            print("  {:<44} {:>8} {:>7} {:>10} {:>10} {:>10} {:>10}".format(name, summary['throughput_rps'], summary['errors'],
+                str(summary['latency_ms_p50']), str(summary['latency_ms_p99']), str(summary['ttfb_ms_p50']), str(summary['ttfb_ms_p99'])))
+
+
+def _print_comparison(results, baseline):
+    """
+    Prints the relative change of each compared metric from the matching scenario of the baseline results - marking
+    changes for the worse with '!'.
+    """
+    def scenario_key(scenario):
+        return (scenario['area_count'], scenario['vertex_count'], scenario['farm_os_latency_ms'], scenario['concurrency'])
+
+    baseline_scenarios = {scenario_key(scenario): scenario for scenario in baseline['scenarios']}
+
+    print("\nCompared to {} ({})".format(baseline.get('git_revision'), baseline.get('started')))
+
+    for scenario in results['scenarios']:
+        baseline_scenario = baseline_scenarios.get(scenario_key(scenario), None)
+
+        if baseline_scenario is None:
+            print("\n{} areas: no matching baseline scenario".format(scenario['area_count']))
+            continue
+
+        print("\n{} areas:".format(scenario['area_count']))
+
+        pairs = [('cold GetCapabilities latency_ms', scenario['cold_get_capabilities']['latency_ms'], baseline_scenario['cold_get_capabilities']['latency_ms'], False),
+                 ('peak_rss_bytes', scenario['peak_rss_bytes'], baseline_scenario['peak_rss_bytes'], False)]
+
+        for (name, summary) in [('all', scenario)] + sorted(scenario['by_request'].items()):
+            baseline_summary = baseline_scenario if name == 'all' else baseline_scenario['by_request'].get(name, {})
+
+            pairs.extend(('{} {}'.format(name, metric), summary.get(metric), baseline_summary.get(metric), higher_is_better)
+                         for (metric, higher_is_better) in COMPARED_METRICS)
+
+        for (name, value, baseline_value, higher_is_better) in pairs:
+            if not value or not baseline_value:
+                continue
+
+            change = (value - baseline_value) / baseline_value
+
+            print("  {} {:<60} {:>14} -> {:<14} {:+.1%}".format('!' if (change < 0) == higher_is_better and change != 0 else ' ',
+                                                                name, baseline_value, value, change))
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    parser = argparse.ArgumentParser(description="Benchmarks the proxy against a local fake FarmOS")
+    parser.add_argument("--area-counts", help="Comma separated numbers of areas to benchmark the proxy with", type=str, default=','.join(map(str, DEFAULT_AREA_COUNTS)))
+    parser.add_argument("--vertex-count", help="The number of vertices of each generated polygon and line string area", type=int, default=DEFAULT_VERTEX_COUNT)
+    parser.add_argument("--farm-os-latency-ms", help="The delay of every fake FarmOS response in milliseconds", type=float, default=0)
+    parser.add_argument("--farm-os-page-size", help="The number of areas per page served by the fake FarmOS", type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument("--concurrency", help="The number of concurrent streams of requests sent to the proxy", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--duration", help="The number of seconds to send requests to the proxy for after its areas were fetched", type=float, default=DEFAULT_DURATION_SECONDS)
+    parser.add_argument("--request-timeout", help="The number of seconds after which a request to the proxy counts as failed", type=float, default=DEFAULT_REQUEST_TIMEOUT_SECONDS)
+    parser.add_argument("--seed", help="The seed for generating areas", type=int, default=0)
+    parser.add_argument("--proxy-args", help="Additional arguments for the proxy, e.g. '--worker-threads=8'", type=str, default='')
+    parser.add_argument("--output-dir", help="Path of a directory to write the results and proxy logs to", type=str, default=DEFAULT_RESULTS_DIR)
+    parser.add_argument("--compare", help="Path of the results of an earlier run to compare this run with", type=str, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    run_name = 'fosafp-bench-' + time.strftime('%Y%m%dT%H%M%S')
+
+    results = {
+        'benchmark': 'fosafp',
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'proxy_args': args.proxy_args,
+        'scenarios': [],
+    }
+
+    for area_count in [int(count) for count in args.area_counts.split(',') if count.strip()]:
+        scenario = yield run_scenario(reactor, args, area_count, run_name)
+
+        scenario.update(vertex_count=args.vertex_count, farm_os_latency_ms=args.farm_os_latency_ms, concurrency=args.concurrency)
+
+        results['scenarios'].append(scenario)
+
+    results_path = os.path.join(args.output_dir, run_name + '.json')
+
+    with open(results_path, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+
+    _print_report(results)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            _print_comparison(results, json.load(baseline_file))
+
+    print("\nWrote results to {}".format(results_path))
+
+
+if __name__ == "__main__":
+    task.react(main)
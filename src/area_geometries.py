@@ -0,0 +1,140 @@
+#!/bin/env python3
+
+import logging
+
+from osgeo import ogr
+
+# Shapely 2 (with NumPy) is optional - when available, the geometries of a whole snapshot are parsed and
+# measured with a handful of vectorized calls instead of a Python loop of OGR calls
+try:
+    import numpy
+    import shapely
+
+    if int(shapely.__version__.split('.')[0]) < 2:
+        raise ImportError("Shapely >= 2 is required for vectorized geometries, found " + shapely.__version__)
+except ImportError:
+    numpy = None
+    shapely = None
+
+
+class AreaGeometries(object):
+    """
+    Parsed geometries of all the areas of a snapshot - in the same order as the areas. OGR geometries are only
+    materialized for the areas a consumer actually asks for.
+    """
+
+    def __init__(self, geo_types, wkts, geometries, bounds):
+        self._geo_types = geo_types
+        self._wkts = wkts
+        self._geometries = geometries
+        self._bounds = bounds
+
+    @classmethod
+    def parse(cls, area_records):
+        """
+        Parses the WKT of the given L{area_snapshot.AreaRecord}s - all at once when Shapely is available. Areas
+        without a geometry or with unreadable WKT get no geometry.
+        """
+        geo_types = [area.geo_type for area in area_records]
+        wkts = [area.geom for area in area_records]
+
+        if shapely is None:
+            return cls._parse_with_ogr(geo_types, wkts)
+
+        geometries = shapely.from_wkt(numpy.array(wkts, dtype=object), on_invalid='ignore')
+
+        # Rows of areas without a geometry are all NaN
+        bounds = shapely.bounds(geometries)
+
+        return cls(numpy.array(geo_types, dtype=object), wkts, geometries, bounds)
+
+    @classmethod
+    def _parse_with_ogr(cls, geo_types, wkts):
+        def envelope(wkt):
+            geometry = None if wkt is None else ogr.CreateGeometryFromWkt(wkt)
+
+            if geometry is None:
+                return None
+
+            (min_x, max_x, min_y, max_y) = geometry.GetEnvelope()
+
+            return (min_x, min_y, max_x, max_y)
+
+        return cls(geo_types, wkts, None, [envelope(wkt) for wkt in wkts])
+
+    def __len__(self):
+        return len(self._wkts)
+
+    @property
+    def approximate_size(self):
+        """Approximate size in bytes of the parsed geometries beyond the WKT they were parsed from."""
+        if shapely is None:
+            return len(self._wkts) * 64
+
+        return self._bounds.nbytes + int(shapely.get_num_coordinates(self._geometries).sum()) * 24 + len(self._wkts) * 96
+
+    def indices_of_type(self, geo_type):
+        """
+        Returns the indices of the areas with the given geojson type and a readable geometry.
+        """
+        if shapely is None:
+            return [index for (index, (area_geo_type, bounds)) in enumerate(zip(self._geo_types, self._bounds))
+                    if area_geo_type == geo_type and not bounds is None]
+
+        return numpy.flatnonzero((self._geo_types == geo_type) & ~numpy.isnan(self._bounds[:, 0])).tolist()
+
+    def layer_extents(self):
+        """
+        Returns a dict of geojson type to the (min_x, min_y, max_x, max_y) extent of all the areas of that type.
+        """
+        layer_extents = {}
+
+        for geo_type in set(self._geo_types):
+            if geo_type is None:
+                continue
+
+            indices = self.indices_of_type(geo_type)
+
+            if not indices:
+                continue
+
+            if shapely is None:
+                type_bounds = [self._bounds[index] for index in indices]
+
+                layer_extents[geo_type] = (
+                    min(b[0] for b in type_bounds),
+                    min(b[1] for b in type_bounds),
+                    max(b[2] for b in type_bounds),
+                    max(b[3] for b in type_bounds),
+                )
+            else:
+                type_bounds = self._bounds[indices]
+
+                layer_extents[geo_type] = tuple(map(float, (
+                    type_bounds[:, 0].min(),
+                    type_bounds[:, 1].min(),
+                    type_bounds[:, 2].max(),
+                    type_bounds[:, 3].max(),
+                )))
+
+        return layer_extents
+
+    def ogr_geometries(self, indices):
+        """
+        Returns a list of new C{osgeo.ogr.Geometry} instances for the areas at the given indices.
+        """
+        if shapely is None:
+            return [ogr.CreateGeometryFromWkt(self._wkts[index]) for index in indices]
+
+        if not indices:
+            return []
+
+        # WKB round trips exactly and is much cheaper for OGR to read than WKT
+        return [ogr.CreateGeometryFromWkb(wkb) for wkb in shapely.to_wkb(self._geometries[indices], output_dimension=3)]
+
+
+def log_geometry_backend():
+    if shapely is None:
+        logging.info("Parsing area geometries with OGR. Install Shapely >= 2 to parse them in vectorized batches")
+    else:
+        logging.info("Parsing area geometries in vectorized batches with Shapely {}".format(shapely.__version__))
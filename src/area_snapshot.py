@@ -0,0 +1,156 @@
+#!/bin/env python3
+
+import sys
+
+from itertools import count
+
+from twisted.internet import defer
+from twisted.python import failure
+
+
+# Rough per-record overhead of the slotted record, its field values tuple, and its strings
+_AREA_RECORD_OVERHEAD_BYTES = 200
+
+# Values of these fields - like geometry types - repeat across nearly all areas so their strings are shared
+_SHARED_VALUE_FIELD_NAMES = {'area_type'}
+
+
+class AreaRecord(object):
+    """
+    Compact record holding just the parts of a restws area entity which the proxy serves.
+    """
+
+    __slots__ = ('tid', 'changed', 'geo_type', 'geom', 'field_values')
+
+    def __init__(self, tid, changed, geo_type, geom, field_values):
+        self.tid = tid
+        """Id of the area's taxonomy term."""
+
+        self.changed = changed
+        """Timestamp of the last change of the area as reported by FarmOS."""
+
+        self.geo_type = geo_type
+        """GeoJSON type of the area's geometry. None unless the area has exactly one geofield."""
+
+        self.geom = geom
+        """WKT of the area's geometry. None unless the area has exactly one geofield."""
+
+        self.field_values = field_values
+        """Tuple of the area's values for the field names of its snapshot - None for missing values."""
+
+    @classmethod
+    def from_entity(cls, area, field_names):
+        geofield = area.get('geofield', [])
+
+        (geo_type, geom) = (None, None)
+
+        if len(geofield) == 1:
+            geo_type = geofield[0].get('geo_type')
+            geom = geofield[0].get('geom')
+
+        field_values = tuple(_intern(area.get(field_name, None)) if field_name in _SHARED_VALUE_FIELD_NAMES else area.get(field_name, None)
+                             for field_name in field_names)
+
+        return cls(area.get('tid'), area.get('changed'), _intern(geo_type), geom, field_values)
+
+
+class AreaSnapshot(object):
+    """
+    Immutable view of all the areas fetched for a single FarmOS client along with any data derived from them. The
+    areas may be restws area entities or - to reuse them - L{AreaRecord}s of another snapshot with the same field names.
+    """
+
+    _versions = count(1)
+
+    def __init__(self, areas, field_names):
+        self.field_names = tuple(field_names)
+        """Names of the area fields kept in this snapshot."""
+
+        self.areas = tuple(area if isinstance(area, AreaRecord) else AreaRecord.from_entity(area, self.field_names) for area in areas)
+        """L{AreaRecord}s of the restws area entities of this snapshot - only keeping the fields named by field_names."""
+
+        self.version = next(AreaSnapshot._versions)
+        """Process-wide unique version number of this snapshot."""
+
+        changed_timestamps = [_timestamp(area.changed) for area in self.areas]
+
+        self.newest_changed = max(filter(lambda changed: not changed is None, changed_timestamps), default=None)
+        """Timestamp of the most recent change to any of the areas of this snapshot. None if there are no areas."""
+
+        self._newest_changed_tids = frozenset(area.tid for (area, changed) in zip(self.areas, changed_timestamps) if changed == self.newest_changed)
+
+        self._derived = {}
+        self._pending_derived = {}
+
+    def __len__(self):
+        return len(self.areas)
+
+    def __iter__(self):
+        return iter(self.areas)
+
+    def is_newest_change(self, tid, changed):
+        """
+        Returns whether the area with the given tid was - as of this snapshot - among the most recently changed areas
+        and last changed at the given timestamp.
+        """
+        return not self.newest_changed is None and _timestamp(changed) == self.newest_changed and tid in self._newest_changed_tids
+
+    def approximate_size(self):
+        """
+        Returns the approximate size in bytes of the areas of this snapshot - excluding anything derived from them.
+        """
+        def record_size(area):
+            return _AREA_RECORD_OVERHEAD_BYTES + len(area.tid or '') + len(area.changed or '') + len(area.geom or '') \
+                + sum(len(str(v)) for v in area.field_values if not v is None)
+
+        return sum(map(record_size, self.areas))
+
+    def derived(self, key, fn):
+        """
+        Returns a Deferred which fires with the value derived from this snapshot for the given key. fn may return
+        a value or a Deferred and is called to compute the value the first time it is requested. Concurrent callers
+        share a single computation and failed computations are not remembered.
+        """
+        if key in self._derived:
+            return defer.succeed(self._derived[key])
+
+        d = defer.Deferred()
+
+        waiters = self._pending_derived.get(key, None)
+
+        if not waiters is None:
+            waiters.append(d)
+            return d
+
+        self._pending_derived[key] = [d]
+
+        def complete(result):
+            waiters = self._pending_derived.pop(key)
+
+            if not isinstance(result, failure.Failure):
+                self._derived[key] = result
+
+            for waiter in waiters:
+                # Cancelled waiters don't cancel the shared computation
+                if waiter.called:
+                    continue
+
+                if isinstance(result, failure.Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+
+        defer.maybeDeferred(fn).addBoth(complete)
+
+        return d
+
+
+def _intern(v):
+    return sys.intern(v) if isinstance(v, str) else v
+
+
+def _timestamp(v):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return None
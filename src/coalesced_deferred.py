@@ -0,0 +1,47 @@
+#!/bin/env python3
+
+from twisted.internet import defer
+from twisted.python import failure
+
+
+class CoalescedDeferred(object):
+    """
+    Shares the result of a single Deferred between any number of waiters. Cancelling a waiter only detaches it;
+    the shared Deferred itself is cancelled once no waiters are left. The owner passes the result of the shared
+    Deferred on to complete.
+    """
+
+    def __init__(self, deferred):
+        self._deferred = deferred
+        self._waiters = []
+        self._result = None
+        self.completed = False
+
+    def wait(self):
+        if self.completed:
+            return defer.fail(self._result) if isinstance(self._result, failure.Failure) else defer.succeed(self._result)
+
+        waiter = defer.Deferred(self._cancel_waiter)
+        self._waiters.append(waiter)
+        return waiter
+
+    def complete(self, result):
+        self.completed = True
+        self._result = result
+
+        (waiters, self._waiters) = (self._waiters, [])
+
+        for waiter in waiters:
+            if isinstance(result, failure.Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+        # Failures were passed on to the waiters so don't let them be reported as unhandled
+        return None
+
+    def _cancel_waiter(self, waiter):
+        self._waiters.remove(waiter)
+
+        if not self._waiters and not self.completed:
+            self._deferred.cancel()
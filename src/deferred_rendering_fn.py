@@ -1,4 +1,4 @@
-import logging
+import sys, logging
 
 from functools import wraps
 
@@ -11,12 +11,37 @@ def deferred_rendering_fn(f):
     def wrapper(self, request):
         @defer.inlineCallbacks
         def _inner(request):
+            d = defer.maybeDeferred(f, self, request)
+
+            disconnected = []
+
+            def cancel_abandoned_request(reason):
+                # Stop working on - and fetching data for - requests which the client has given up on
+                disconnected.append(reason)
+                d.cancel()
+
+            request.notifyFinish().addErrback(cancel_abandoned_request)
+
             try:
-                result = yield defer.maybeDeferred(f, self, request)
+                result = yield d
                 request.write(result)
-            except:
+            except defer.CancelledError:
+                if disconnected:
+                    logging.info("Cancelled request abandoned by the client: {}".format(request.uri))
+                    return
                 logging.error(logging.traceback.format_exc())
                 request.setResponseCode(500)
+            except:
+                retry_after_seconds = getattr(sys.exc_info()[1], 'retry_after_seconds', None)
+
+                # Exceptions with a retry_after_seconds attribute signal a temporary overload rather than a bug
+                if retry_after_seconds is None:
+                    logging.error(logging.traceback.format_exc())
+                    request.setResponseCode(500)
+                else:
+                    logging.warning("Rejected request with '503 Service Unavailable': {}".format(sys.exc_info()[1]))
+                    request.setResponseCode(503)
+                    request.setHeader(b'Retry-After', str(int(retry_after_seconds)).encode('utf-8'))
             request.finish()
         _inner(request)
         return NOT_DONE_YET
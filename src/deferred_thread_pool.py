@@ -0,0 +1,76 @@
+import threading
+
+from twisted.internet import defer, threads
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
+
+
+DEFAULT_THREAD_POOL_SIZE = 4
+
+_current_work = threading.local()
+
+
+def create_thread_pool(reactor, size=DEFAULT_THREAD_POOL_SIZE, name="FarmOsAreaFeatureProxyWorkers"):
+    """
+    Creates a bounded thread pool whose lifecycle is tied to that of the given reactor.
+    """
+    thread_pool = ThreadPool(minthreads=0, maxthreads=size, name=name)
+
+    reactor.callWhenRunning(thread_pool.start)
+    reactor.addSystemEventTrigger('during', 'shutdown', thread_pool.stop)
+
+    return thread_pool
+
+
+def run_in_thread_pool(thread_pool, f, *args, **kwargs):
+    """
+    Returns a Deferred that fires with the result of calling f in the given thread pool or directly
+    on the calling thread if the thread pool is None.
+
+    Only suitable for work that doesn't touch reactor state - mostly the CPU-bound GDAL/OGR and lxml
+    calls which release the GIL.
+
+    Cancelling the returned Deferred skips calling f if it hasn't started yet. Otherwise f keeps running
+    until it calls raise_if_cancelled.
+    """
+    if thread_pool is None:
+        return defer.maybeDeferred(f, *args, **kwargs)
+
+    from twisted.internet import reactor
+
+    cancelled = threading.Event()
+
+    def run_unless_cancelled():
+        if cancelled.is_set():
+            raise defer.CancelledError()
+
+        _current_work.cancelled = cancelled
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _current_work.cancelled = None
+
+    result = defer.Deferred(lambda _result: cancelled.set())
+
+    def complete(outcome):
+        # The result of work which was cancelled while running is discarded
+        if not result.called:
+            if isinstance(outcome, failure.Failure):
+                result.errback(outcome)
+            else:
+                result.callback(outcome)
+
+    threads.deferToThreadPool(reactor, thread_pool, run_unless_cancelled).addBoth(complete)
+
+    return result
+
+
+def raise_if_cancelled():
+    """
+    Raises CancelledError if the work calling this - via run_in_thread_pool - has been cancelled. Long running
+    loops should call this periodically so that abandoned work stops early.
+    """
+    cancelled = getattr(_current_work, 'cancelled', None)
+
+    if not cancelled is None and cancelled.is_set():
+        raise defer.CancelledError()
@@ -1,113 +1,294 @@
 #!/bin/env python3
 
-import sys, argparse, logging
-from functools import partial, lru_cache
+import os, re, sys, json, time, argparse, logging, threading, socket, tempfile, secrets, shutil, hmac, hashlib, signal
+from functools import partial
 
 from twisted.application import service, strports
-from twisted.python import log
+from twisted.python import log, failure
 from twisted.web import server
-from twisted.internet import reactor, defer, task
-
-from cachetools import cached, TTLCache
+from twisted.internet import reactor, defer, task, protocol, error
 
 from osgeo import ogr, osr
 
+from area_geometries import AreaGeometries, log_geometry_backend
+from area_snapshot import AreaSnapshot
+from coalesced_deferred import CoalescedDeferred
+from deferred_thread_pool import create_thread_pool, run_in_thread_pool, DEFAULT_THREAD_POOL_SIZE
+import metrics
+from metrics import area_cache_lookups_total, area_cache_refresh_seconds, area_cache_refresh_failures_total, commit_operations_total
+from shared_area_snapshot_store import SharedAreaSnapshotStore
+from stage_timings import stage_timings, NO_STAGE_TIMINGS
+from persistent_area_snapshot_store import PersistentAreaSnapshotStore
+from sampling_profiler import SamplingProfiler, DEFAULT_PROFILE_SECONDS
 from tx_farm_os_client import TxFarmOsClient
-from wfs_resource import WfsResource, LayerDefinition, FeatureField, Feature, TransactionOutcome, CommitOutcomeItem
+from tx_drupal_rest_ws_client import TxDrupalSessionStore, TxDrupalLatencyTracker, DEFAULT_REQUEST_TIMEOUT_SECONDS
+from upstream_scheduler import UpstreamScheduler, UpstreamOverloadedError, INTERACTIVE, BACKGROUND, PRIORITY_NAMES, DEFAULT_MAX_CONCURRENCY, DEFAULT_MAX_QUEUED
+from user_cache_registry import UserCacheRegistry
+from wfs_resource import WfsResource, DEFAULT_SLOW_REQUEST_SECONDS, LayerDefinition, FeatureField, Feature, TransactionOutcome, CommitOutcomeItem
 
 
 AREAS_CACHE_SECONDS = 60
-CLIENT_INSTANCE_CACHE_SIZE = 32
+# Expired areas are only fetched again once a cheap probe shows that they changed - but at least this often
+AREAS_MAX_UNCHANGED_SECONDS = 15 * 60
 TRANSACTION_COMMIT_PARALLELISM = 16
 
+# Approximate memory budget for the clients, areas, and features cached across all users
+DEFAULT_USER_CACHE_MAX_MEGABYTES = 512
+USER_CACHE_STATS_LOG_SECONDS = 5 * 60
+
+PERSISTENT_AREAS_MAX_AGE_SECONDS = 7 * 24 * 60 * 60
+
+# Sending this signal to the proxy - or to the parent of its worker processes - starts a profile
+PROFILE_SIGNAL = signal.SIGUSR2
+
+IDENTITY_SECRET_ENV = 'FOSAFP_IDENTITY_SECRET'
+
+# Worker processes which die are started again after a delay doubling from the minimum up to the maximum - reset once a
+# worker stayed up for the maximum
+WORKER_RESTART_MIN_SECONDS = 1
+WORKER_RESTART_MAX_SECONDS = 60
+
+# Refresh warm areas well before the areas of interactive users would expire
+WARM_AREAS_REFRESH_SECONDS = 45
+# Failing warm areas refreshes are retried after a delay doubling up to the maximum - and given up on for credentials
+# which never worked
+WARM_AREAS_MAX_RETRY_SECONDS = 30 * 60
+WARM_AREAS_MAX_UNPROVEN_FAILURES = 5
+
+# Layers of the areas by their geometry type - with the geojson type being the layer type without underscores
+LAYER_TYPES = ('point', 'polygon', 'line_string')
+
+# The only area fields served by the layers - and the only ones kept in cached area snapshots
+AREA_FIELD_NAMES = ('name', 'area_type', 'description')
+
+DEFAULT_SRS = 'EPSG:4326'
+DEFAULT_SUPPORTED_SRS = ('EPSG:4326', 'EPSG:3857')
+
+# Geometries are only simplified when tolerances (in units of DEFAULT_SRS) are configured
+DEFAULT_SIMPLIFICATION_TOLERANCES = ()
+
 
 class _AllAreasCacheCell(object):
-    def __init__(self, _ignored):
+    def __init__(self):
         self.lock = defer.DeferredLock()
         self.value = None
+        self.fetched_time = None
+        self.loaded_time = None
+        self.extents = None
+        self.areas_size = 0
+        self.shared_snapshot_modification_time = None
+        self.persisted_checked = False
+        self.refill = None
+
+class _UserCache(object):
+    def __init__(self, farm_os_client):
+        self.farm_os_client = farm_os_client
+        self.all_areas = _AllAreasCacheCell()
+        self.http_cache_size = 0
+
+class _SpatialReferenceSystems(threading.local):
+    # OSR objects must not be shared between threads so each thread builds its own set, once, the first time
+    # it needs them
+    def __init__(self, supported_srs):
+        self.spatial_references = {srs: _create_spatial_reference(srs) for srs in set(supported_srs) | {DEFAULT_SRS}}
+
+        # CoordinateTransformations are relatively expensive to create so build them once up front
+        self.coordinate_transformations = {
+            srs: osr.CoordinateTransformation(self.spatial_references[DEFAULT_SRS], spatial_reference)
+            for srs, spatial_reference in self.spatial_references.items() if srs != DEFAULT_SRS
+        }
+        self.inverse_coordinate_transformations = {
+            srs: osr.CoordinateTransformation(spatial_reference, self.spatial_references[DEFAULT_SRS])
+            for srs, spatial_reference in self.spatial_references.items() if srs != DEFAULT_SRS
+        }
 
 class FarmOsProxyFeatureServer(object):
     name = "FarmOsProxyFeatureServer"
 
-    def __init__(self, farm_os_url):
-        farm_os_client_creation_lock = defer.DeferredLock()
+    def __init__(self, farm_os_url, supported_srs=DEFAULT_SUPPORTED_SRS, simplification_tolerances=DEFAULT_SIMPLIFICATION_TOLERANCES, thread_pool=None,
+                 identity_secret=None, shared_area_snapshot_store=None, persistent_area_snapshot_store=None, session_store=None,
+                 user_cache_max_bytes=DEFAULT_USER_CACHE_MAX_MEGABYTES * 1024 * 1024, farm_os_http_cache_size=0, upstream_scheduler=None,
+                 farm_os_request_timeout_seconds=DEFAULT_REQUEST_TIMEOUT_SECONDS, farm_os_hedging_percentile=None):
+        self._thread_pool = thread_pool
+        self._identity_secret = identity_secret or secrets.token_bytes(32)
+        self._shared_area_snapshot_store = shared_area_snapshot_store
+        self._persistent_area_snapshot_store = persistent_area_snapshot_store
+
+        self._spatial_reference_systems = _SpatialReferenceSystems(supported_srs)
+        self._other_srs = sorted(set(supported_srs) - {DEFAULT_SRS})
+
+        self._simplification_tolerances = tuple(sorted(set(simplification_tolerances)))
 
-        self._create_farm_os_client = partial(farm_os_client_creation_lock.run,
-                                              lru_cache(maxsize=CLIENT_INSTANCE_CACHE_SIZE)(partial(TxFarmOsClient.create, farm_os_url, user_agent="FarmOsAreaFeatureProxy")))
+        create_farm_os_client = partial(TxFarmOsClient.create, farm_os_url, user_agent="FarmOsAreaFeatureProxy", session_store=session_store,
+                                        http_cache_size=farm_os_http_cache_size, upstream_scheduler=upstream_scheduler,
+                                        request_timeout_seconds=farm_os_request_timeout_seconds,
+                                        hedging_latency_tracker=TxDrupalLatencyTracker(farm_os_hedging_percentile) if farm_os_hedging_percentile else None)
 
-        all_areas_cache_lock = defer.DeferredLock()
-        self._get_all_areas_cache_cell = partial(all_areas_cache_lock.run,
-                                                 cached(cache=TTLCache(maxsize=CLIENT_INSTANCE_CACHE_SIZE, ttl=AREAS_CACHE_SECONDS))(_AllAreasCacheCell))
+        # Everything cached for a user lives and gets evicted together, keyed by a hash of their credentials. Looking
+        # up - or creating - a user's cache never yields to the reactor so it needs no locking; only filling a user's
+        # areas cache cell is serialized, and only per user.
+        self._user_caches = UserCacheRegistry(lambda _identity_key, user, password: _UserCache(create_farm_os_client(user, password)),
+                                              max_bytes=user_cache_max_bytes,
+                                              # Pending session refreshes can keep the client of an evicted user alive for a while
+                                              release_value=lambda user_cache: user_cache.farm_os_client.drupal_client.clear_http_cache())
+
+        metrics.user_cache_bytes.set_function(lambda: self._user_caches.total_size)
+        metrics.user_cache_entries.set_function(lambda: len(self._user_caches))
+
+        if not upstream_scheduler is None:
+            metrics.upstream_active_requests.set_function(lambda: upstream_scheduler.active)
+            metrics.upstream_queued_requests.set_function(lambda: upstream_scheduler.queued)
 
     def layer_definitions(self, request):
+        # Only extents which are already cached are included - see layer_extents
+        layer_extents = self._get_cached_layer_extents(request)
+
         return [
             LayerDefinition(
                 name='farm_os_features_' + layer_type,
                 title="FarmOS {} features".format(layer_type.replace('_', ' ')),
-                default_srs='EPSG:4326',
+                default_srs=DEFAULT_SRS,
+                other_srs=self._other_srs,
                 geometry_type="{}PropertyType".format(''.join(map(str.capitalize, layer_type.split('_')))),
                 operations={'Query', 'Insert', 'Update', 'Delete'},
                 fields=(
-                    FeatureField(name=field_name, field_type='string', required=(field_name != 'description')) for field_name in ('name', 'area_type', 'description')
+                    FeatureField(name=field_name, field_type='string', required=(field_name != 'description')) for field_name in AREA_FIELD_NAMES
                 ),
-                ext={'geojson_type': layer_type.replace('_', '')}
-            ) for layer_type in ('point', 'polygon', 'line_string')
+                ext={'geojson_type': layer_type.replace('_', '')},
+                lat_long_bounding_box=layer_extents.get(layer_type.replace('_', ''), None)
+            ) for layer_type in LAYER_TYPES
         ]
 
     @defer.inlineCallbacks
-    def get_all_features(self, layer_def, request):
-        farm_os_client = yield self._create_farm_os_client(request.getUser(), request.getPassword())
+    def layer_extents(self, request):
+        # Avoid bothering FarmOS with requests which can't be authenticated
+        if not request.getUser():
+            return {}
+
+        try:
+            user_cache = self._user_cache(request)
+
+            cache_cell = user_cache.value.all_areas
+
+            if cache_cell.extents is None:
+                yield self._fill_all_areas_cache_cell(user_cache, stage_timings(request))
+
+            return _layer_extents_by_name(cache_cell.extents or {})
+        except defer.CancelledError:
+            raise
+        except:
+            logging.error(logging.traceback.format_exc())
+            return {}
+
+    def _get_cached_layer_extents(self, request):
+        if not request.getUser() or not self._identity_key(request) in self._user_caches:
+            return {}
+
+        return self._user_cache(request).value.all_areas.extents or {}
+
+    @defer.inlineCallbacks
+    def get_all_features(self, layer_def, request, query=None):
+        user_cache = self._user_cache(request)
+
+        timings = stage_timings(request)
+
+        area_snapshot = yield self._fill_all_areas_cache_cell(user_cache, timings)
+
+        srs = getattr(query, 'srs', None) or layer_def.default_srs
+
+        simplification_tolerance = self._select_simplification_tolerance(layer_def, query)
+
+        # Features are cached per snapshot so repeated requests for the same layer/srs/level of detail
+        # don't re-parse, re-simplify, or re-project any geometries
+        @defer.inlineCallbacks
+        def derive_layer_features():
+            area_geometries = yield self._area_geometries(area_snapshot)
+
+            (layer_features, features_size) = yield run_in_thread_pool(self._thread_pool, lambda: _with_approximate_features_size(
+                list(self._to_type_filtered_layer_features(layer_def, area_snapshot, area_geometries, srs, simplification_tolerance))))
+
+            self._add_derived_size(user_cache, area_snapshot, features_size)
+
+            return layer_features
 
-        geojson_area_features = yield self._cached_get_all_areas(farm_os_client)
+        with timings.stage('features'):
+            layer_features = yield area_snapshot.derived(('layer_features', layer_def.name, srs, simplification_tolerance), derive_layer_features)
 
-        return self._to_type_filtered_layer_features(layer_def, geojson_area_features)
+        return layer_features
 
-    def _to_type_filtered_layer_features(self, layer_def, geojson_area_features):
-        def to_layer_feature(geojson_area_feature):
-            geofield = geojson_area_feature.get('geofield', [])
+    def _select_simplification_tolerance(self, layer_def, query):
+        if not self._simplification_tolerances or layer_def.ext.geojson_type == 'point':
+            return None
 
-            if len(geofield) != 1:
-                return None
+        # Simplified geometries keep the feature ids of the full ones and editing them would commit their missing vertices,
+        # so they are only served to clients asking for them explicitly
+        requested_tolerance = getattr(query, 'simplification_tolerance', None)
 
-            if geofield[0]['geo_type'] != layer_def.ext.geojson_type:
-                return None
+        if requested_tolerance is None:
+            return None
 
-            area_id = geojson_area_feature.get('tid')
+        # Use the coarsest precomputable level of detail which is still within the requested tolerance
+        return next(filter(lambda tolerance: tolerance <= requested_tolerance, reversed(self._simplification_tolerances)), None)
 
-            feature_id = layer_def.name + '.' + area_id
+    def _geometry_in_default_srs(self, geometry, srs):
+        inverse_coordinate_transformation = self._spatial_reference_systems.inverse_coordinate_transformations.get(srs, None)
 
-            def extract_field_items():
-                for field in layer_def.fields:
-                    v = geojson_area_feature.get(field.name, None)
+        if inverse_coordinate_transformation is None:
+            return geometry
 
-                    if v is None:
-                        continue
+        # Committed geometries may also be WktGeometries which can't be transformed themselves
+        transformed_geometry = ogr.CreateGeometryFromWkt(geometry.ExportToWkt())
 
-                    yield (field.name, v)
+        if transformed_geometry is None or transformed_geometry.Transform(inverse_coordinate_transformation) != 0:
+            raise ValueError("Failed to transform geometry from {} to {}".format(srs, DEFAULT_SRS))
 
-            field_data = {field_name: field_value for (field_name, field_value) in extract_field_items()}
+        return transformed_geometry
 
-            geometry = ogr.CreateGeometryFromWkt(geofield[0].get('geom'))
+    def _to_type_filtered_layer_features(self, layer_def, area_snapshot, area_geometries, srs, simplification_tolerance=None):
+        spatial_reference = self._spatial_reference_systems.spatial_references[layer_def.default_srs]
+        coordinate_transformation = self._spatial_reference_systems.coordinate_transformations.get(srs, None)
 
-            srs = osr.SpatialReference()
-            srs.SetFromUserInput(layer_def.default_srs)
+        # Only the areas of the layer's type get their OGR geometries materialized
+        indices = area_geometries.indices_of_type(layer_def.ext.geojson_type)
 
-            geometry.AssignSpatialReference( srs )
+        layer_field_names = {field.name for field in layer_def.fields}
+
+        def to_layer_feature(index, geometry):
+            area = area_snapshot.areas[index]
+
+            feature_id = layer_def.name + '.' + area.tid
+
+            field_data = {field_name: v for (field_name, v) in zip(area_snapshot.field_names, area.field_values)
+                          if not v is None and field_name in layer_field_names}
+
+            geometry.AssignSpatialReference( spatial_reference )
+
+            if simplification_tolerance:
+                geometry = geometry.SimplifyPreserveTopology(simplification_tolerance)
+                geometry.AssignSpatialReference( spatial_reference )
+
+            if not coordinate_transformation is None:
+                geometry.Transform(coordinate_transformation)
 
             return Feature(feature_id=feature_id, geometry=geometry, field_data=field_data)
 
-        layer_features = map(to_layer_feature, geojson_area_features)
+        return map(to_layer_feature, indices, area_geometries.ogr_geometries(indices))
 
-        return filter(lambda feature: feature is not None, layer_features)
+    def commit_transaction(self, transaction, request):
+        # Once started, commits always run to completion - and expire the cache - even if the client goes away
+        return _shield_from_cancellation(self._commit_transaction(transaction, request))
 
     @defer.inlineCallbacks
-    def commit_transaction(self, transaction, request):
-        farm_os_client = yield self._create_farm_os_client(request.getUser(), request.getPassword())
+    def _commit_transaction(self, transaction, request):
+        user_cache = self._user_cache(request)
+
+        farm_os_client = user_cache.value.farm_os_client
 
         inserted_features = []
         updated_features = []
         deleted_features = []
         transaction_failures = []
+        committed_extents = []
 
         def work_iter():
             for feature_to_insert in transaction.features_to_insert:
@@ -115,18 +296,22 @@ class FarmOsProxyFeatureServer(object):
                 def insert_feature_work():
                     record = {}
                     record.update(feature_to_insert.field_data)
-                    record['geofield'] = [
-                        {
-                            "geom": feature_to_insert.geometry.ExportToWkt()
-                        }
-                    ]
 
                     try:
+                        geometry = self._geometry_in_default_srs(feature_to_insert.geometry, feature_to_insert.srs)
+
+                        record['geofield'] = [
+                            {
+                                "geom": geometry.ExportToWkt()
+                            }
+                        ]
+
                         response = yield farm_os_client.area.create(record)
 
                         feature_id = feature_to_insert.layer_def.name + '.' + response.get('id')
 
                         inserted_features.append(CommitOutcomeItem(data=feature_id, layer_def=feature_to_insert.layer_def, handle=feature_to_insert.handle))
+                        committed_extents.append((feature_to_insert.layer_def.ext.geojson_type, _geometry_extent(geometry)))
                     except:
                         formatted_exception = logging.traceback.format_exc()
                         logging.error(formatted_exception)
@@ -144,17 +329,24 @@ class FarmOsProxyFeatureServer(object):
                     record = {}
                     record.update(feature_to_update.field_data)
 
-                    if not feature_to_update.geometry is None:
-                        record['geofield'] = [
-                            {
-                                "geom": feature_to_update.geometry.ExportToWkt()
-                            }
-                        ]
-
                     try:
+                        geometry = None
+
+                        if not feature_to_update.geometry is None:
+                            geometry = self._geometry_in_default_srs(feature_to_update.geometry, feature_to_update.srs)
+
+                            record['geofield'] = [
+                                {
+                                    "geom": geometry.ExportToWkt()
+                                }
+                            ]
+
                         yield farm_os_client.area.update(numeric_feature_id, record)
 
                         updated_features.append(CommitOutcomeItem(data=feature_id, layer_def=feature_to_update.layer_def, handle=feature_to_update.handle))
+
+                        if not geometry is None:
+                            committed_extents.append((feature_to_update.layer_def.ext.geojson_type, _geometry_extent(geometry)))
                     except:
                         formatted_exception = logging.traceback.format_exc()
                         logging.error(formatted_exception)
@@ -183,9 +375,27 @@ class FarmOsProxyFeatureServer(object):
 
         work = work_iter()
 
-        yield defer.gatherResults([cooperator.coiterate(work) for _ignored in range(TRANSACTION_COMMIT_PARALLELISM)])
+        with stage_timings(request).stage('commit'):
+            yield defer.gatherResults([cooperator.coiterate(work) for _ignored in range(TRANSACTION_COMMIT_PARALLELISM)])
 
-        yield self._expire_all_areas_cache(farm_os_client)
+        for (operation, features, committed_features) in (('insert', transaction.features_to_insert, inserted_features),
+                                                          ('update', transaction.features_to_update, updated_features),
+                                                          ('delete', transaction.features_to_delete, deleted_features)):
+            commit_operations_total.inc(len(committed_features), operation=operation, outcome='success')
+            commit_operations_total.inc(len(features) - len(committed_features), operation=operation, outcome='failure')
+
+        if inserted_features or updated_features or deleted_features:
+            self._user_caches.prove(user_cache)
+
+        # Failed inserts may still have created areas whose tids are unknown so only the full set of areas will do
+        if transaction_failures:
+            yield self._expire_all_areas_cache(user_cache, committed_extents)
+        else:
+            changed_tids = [committed_feature.data.rsplit('.', 1)[1] for committed_feature in inserted_features + updated_features]
+            deleted_tids = [committed_feature.data.rsplit('.', 1)[1] for committed_feature in deleted_features]
+
+            with stage_timings(request).stage('fetch'):
+                yield self._refresh_committed_areas(user_cache, changed_tids, deleted_tids, committed_extents)
 
         return TransactionOutcome(
             inserted_features=inserted_features,
@@ -194,48 +404,584 @@ class FarmOsProxyFeatureServer(object):
             transaction_failures=transaction_failures
         )
 
+    def keep_warm(self, user, password, refresh_seconds=WARM_AREAS_REFRESH_SECONDS):
+        """
+        Logs in with the given credentials and keeps their areas cached - refreshing them periodically - so that
+        requests with those credentials never have to wait for the areas to be fetched. Failing refreshes are retried
+        less and less often and given up on if the credentials never worked. Returns the LoopingCall doing the
+        refreshing.
+        """
+        failures = 0
+        skipped_refreshes = 0
+
+        @defer.inlineCallbacks
+        def refresh():
+            nonlocal failures, skipped_refreshes
+
+            if skipped_refreshes:
+                skipped_refreshes -= 1
+                return
+
+            user_cache = self._user_caches.get(self._identity_key_for(user, password), user, password)
+
+            # Unlike those of other users, the cached areas of warm users never expire or get evicted
+            self._user_caches.pin(user_cache)
+
+            try:
+                # Holding the lock lets concurrent misses wait for the refresh instead of fetching the areas again
+                yield user_cache.value.all_areas.lock.run(self._refresh_warm_areas, user_cache)
+            except:
+                failures += 1
+
+                if not user_cache.proven and failures >= WARM_AREAS_MAX_UNPROVEN_FAILURES:
+                    logging.error("Giving up keeping the areas of {} warm after {} failures: {}".format(
+                        user.decode('utf-8', 'replace'), failures, logging.traceback.format_exc()))
+                    refresh_loop.stop()
+                    self._user_caches.discard(user_cache)
+                    return
+
+                skipped_refreshes = min(2 ** failures, max(1, int(WARM_AREAS_MAX_RETRY_SECONDS // refresh_seconds))) - 1
+
+                logging.error("Failed to refresh the areas of {} - retrying in {} seconds: {}".format(
+                    user.decode('utf-8', 'replace'), (skipped_refreshes + 1) * refresh_seconds, logging.traceback.format_exc()))
+                return
+
+            failures = 0
+
+        refresh_loop = task.LoopingCall(refresh)
+        refresh_loop.start(refresh_seconds, now=True)
+
+        return refresh_loop
+
     @defer.inlineCallbacks
-    def _cached_get_all_areas(self, farm_os_client):
-        cache_cell = yield self._get_all_areas_cache_cell(id(farm_os_client))
+    def _refresh_warm_areas(self, user_cache):
+        cache_cell = user_cache.value.all_areas
 
-        all_areas = cache_cell.value
+        yield user_cache.value.farm_os_client.area.get_area_vocabulary_id()
 
-        if not all_areas is None:
-            return all_areas
+        if (yield self._is_all_areas_snapshot_unchanged(user_cache, BACKGROUND)):
+            cache_cell.fetched_time = reactor.seconds()
+            return
+
+        all_areas = yield self._load_or_fetch_all_areas(user_cache, partial(self._fetch_all_areas, user_cache, BACKGROUND))
+
+        yield self._update_all_areas_cache_cell(user_cache, all_areas)
+
+    def log_user_cache_stats(self):
+        logging.info("User caches using ~{} bytes: {}".format(self._user_caches.total_size, json.dumps(self._user_caches.stats())))
+
+    def _user_cache(self, request):
+        return self._user_caches.get(self._identity_key(request), request.getUser(), request.getPassword())
+
+    def _identity_key(self, request):
+        return self._identity_key_for(request.getUser(), request.getPassword())
+
+    def _identity_key_for(self, user, password):
+        # Keys identify a set of credentials across stores and worker processes without revealing them
+        return hmac.new(self._identity_secret, b'\0'.join((user or b'', password or b'')), hashlib.sha256).hexdigest()
+
+    def _is_all_areas_cache_current(self, user_cache):
+        cache_cell = user_cache.value.all_areas
+
+        if cache_cell.value is None:
+            return False
+
+        if not user_cache.pinned and reactor.seconds() - cache_cell.fetched_time > AREAS_CACHE_SECONDS:
+            return False
+
+        if self._shared_area_snapshot_store is None:
+            return True
+
+        # Another worker may have committed changes and expired the shared areas
+        return self._shared_area_snapshot_store.modification_time(user_cache.identity_key) == cache_cell.shared_snapshot_modification_time
+
+    @defer.inlineCallbacks
+    def _is_all_areas_snapshot_unchanged(self, user_cache, priority=INTERACTIVE, timings=NO_STAGE_TIMINGS):
+        """
+        Returns a Deferred which fires with whether the cached areas of the given user are known to still match the
+        areas in FarmOS - according to a probe for the number of areas and the most recently changed area.
+        """
+        cache_cell = user_cache.value.all_areas
+
+        area_snapshot = cache_cell.value
+
+        # Changes which don't touch the "changed" timestamp - or happen within the same second - would go unnoticed
+        # so areas which are old enough are always fetched again
+        if area_snapshot is None or reactor.seconds() - cache_cell.loaded_time > AREAS_MAX_UNCHANGED_SECONDS:
+            return False
+
+        # Another worker may have committed changes and expired the shared areas
+        if not self._shared_area_snapshot_store is None and \
+                self._shared_area_snapshot_store.modification_time(user_cache.identity_key) != cache_cell.shared_snapshot_modification_time:
+            return False
+
+        try:
+            with timings.stage('auth'):
+                yield user_cache.value.farm_os_client.drupal_client.ensure_authenticated(priority)
+
+            with timings.stage('probe'):
+                newest_changed = yield user_cache.value.farm_os_client.area.get_newest_changed(priority=priority)
+        except defer.CancelledError:
+            raise
+        except:
+            logging.error(logging.traceback.format_exc())
+            return False
+
+        self._update_http_cache_size(user_cache)
+
+        if newest_changed is None:
+            return False
+
+        (area_count, newest_area) = newest_changed
+
+        if area_count != len(area_snapshot):
+            return False
+
+        return newest_area is None or area_snapshot.is_newest_change(newest_area.get('tid'), newest_area.get('changed'))
+
+    def _fill_all_areas_cache_cell(self, user_cache, timings=NO_STAGE_TIMINGS):
+        # Cache hits - by far the most common case - neither wait on a lock nor run a generator
+        if self._is_all_areas_cache_current(user_cache):
+            self._user_caches.record_hit(user_cache)
+            area_cache_lookups_total.inc(result='hit')
+            return defer.succeed(user_cache.value.all_areas.value)
 
+        return self._refill_all_areas_cache_cell(user_cache, timings)
+
+    def _refill_all_areas_cache_cell(self, user_cache, timings):
+        cache_cell = user_cache.value.all_areas
+
+        # Concurrent misses for the same user share a single refill which keeps going as long as any of them still
+        # waits for it - so clients which go away, e.g. when QGIS cancels requests while panning, don't restart it
+        if not cache_cell.refill is None:
+            self._user_caches.record_hit(user_cache)
+            area_cache_lookups_total.inc(result='hit')
+            return cache_cell.refill.wait()
+
+        d = self._refill_all_areas_cache_cell_exclusively(user_cache, timings)
+
+        refill = CoalescedDeferred(d)
+
+        def forget_refill(result):
+            cache_cell.refill = None
+            return result
+
+        # Registered before the waiters are notified so that they can't join a refill which already finished
+        d.addBoth(forget_refill)
+        d.addBoth(refill.complete)
+
+        # The refill may have finished synchronously
+        if not refill.completed:
+            cache_cell.refill = refill
+
+        return refill.wait()
+
+    @defer.inlineCallbacks
+    def _refill_all_areas_cache_cell_exclusively(self, user_cache, timings):
+        cache_cell = user_cache.value.all_areas
+
+        # Refills wait for anything else updating the cell - like revalidations, commits, and warm refreshes
         yield cache_cell.lock.acquire()
         try:
-            if not cache_cell.value is None:
+            if self._is_all_areas_cache_current(user_cache):
+                self._user_caches.record_hit(user_cache)
+                area_cache_lookups_total.inc(result='hit')
+                return cache_cell.value
+
+            if (yield self._is_all_areas_snapshot_unchanged(user_cache, timings=timings)):
+                self._user_caches.record_hit(user_cache)
+                area_cache_lookups_total.inc(result='unchanged')
+                cache_cell.fetched_time = reactor.seconds()
                 return cache_cell.value
 
-            all_areas = yield farm_os_client.area.get_all()
+            self._user_caches.record_miss(user_cache)
+            area_cache_lookups_total.inc(result='miss')
+
+            fetch_all_areas = partial(self._fetch_all_areas, user_cache, INTERACTIVE, timings)
+
+            try:
+                (all_areas, fetched_time) = (None, None)
+
+                # Persisted areas only stand in for the first miss of a user - later misses follow expiries or changes
+                if not self._persistent_area_snapshot_store is None and not cache_cell.persisted_checked:
+                    cache_cell.persisted_checked = True
+                    (all_areas, fetched_time) = yield self._load_persisted_areas(user_cache)
 
-            cache_cell.value = all_areas
+                if all_areas is None:
+                    all_areas = yield self._load_or_fetch_all_areas(user_cache, fetch_all_areas)
+            except defer.CancelledError:
+                raise
+            except:
+                # Don't let credentials which have never worked - e.g. typo'd passwords - occupy the cache
+                if not user_cache.proven:
+                    self._user_caches.discard(user_cache)
+                raise
+
+            with timings.stage('snapshot'):
+                # Areas persisted before a restart keep their age so they aren't served again once they would have expired
+                all_areas = yield self._update_all_areas_cache_cell(user_cache, all_areas, fetched_time=fetched_time)
 
             return all_areas
         finally:
             cache_cell.lock.release()
 
     @defer.inlineCallbacks
-    def _expire_all_areas_cache(self, farm_os_client):
-        cache_cell = yield self._get_all_areas_cache_cell(id(farm_os_client))
+    def _update_all_areas_cache_cell(self, user_cache, all_areas, fetched_time=None, loaded_time=None):
+        cache_cell = user_cache.value.all_areas
+
+        # Only the fields the layers serve are kept in the snapshot
+        all_areas = yield run_in_thread_pool(self._thread_pool, AreaSnapshot, all_areas, AREA_FIELD_NAMES)
+
+        cache_cell.value = all_areas
+        cache_cell.fetched_time = reactor.seconds() if fetched_time is None else fetched_time
+        cache_cell.loaded_time = reactor.seconds() if loaded_time is None else loaded_time
+
+        area_geometries = yield self._area_geometries(all_areas)
+
+        (cache_cell.extents, cache_cell.areas_size) = yield run_in_thread_pool(self._thread_pool,
+            lambda: (area_geometries.layer_extents(), all_areas.approximate_size() + area_geometries.approximate_size))
+
+        if cache_cell.value is all_areas:
+            self._user_caches.update_size(user_cache, cache_cell.areas_size + user_cache.value.http_cache_size)
+
+        return all_areas
+
+    def _area_geometries(self, area_snapshot):
+        # All the geometries of a snapshot are parsed at once and shared by everything derived from it
+        return area_snapshot.derived('geometries', partial(run_in_thread_pool, self._thread_pool, AreaGeometries.parse, area_snapshot))
+
+    def _add_derived_size(self, user_cache, area_snapshot, size):
+        # Features derived from a snapshot which has since been replaced are no longer reachable through the cache
+        if user_cache.value.all_areas.value is area_snapshot:
+            self._user_caches.update_size(user_cache, user_cache.size + size)
+
+    def _update_http_cache_size(self, user_cache):
+        # The FarmOS responses kept for revalidation are charged to the user's cache like the areas parsed from them
+        http_cache_size = user_cache.value.farm_os_client.drupal_client.http_cache_size
+
+        self._user_caches.update_size(user_cache, user_cache.size - user_cache.value.http_cache_size + http_cache_size)
+
+        user_cache.value.http_cache_size = http_cache_size
+
+    @defer.inlineCallbacks
+    def _fetch_all_areas(self, user_cache, priority=INTERACTIVE, timings=NO_STAGE_TIMINGS):
+        started = reactor.seconds()
+
+        try:
+            with timings.stage('auth'):
+                yield user_cache.value.farm_os_client.drupal_client.ensure_authenticated(priority)
+
+            with timings.stage('fetch'):
+                all_areas = yield user_cache.value.farm_os_client.area.get_all(priority=priority)
+        except defer.CancelledError:
+            raise
+        except:
+            area_cache_refresh_failures_total.inc()
+            raise
+
+        area_cache_refresh_seconds.observe(reactor.seconds() - started, priority=PRIORITY_NAMES[priority])
+
+        self._user_caches.prove(user_cache)
+
+        self._update_http_cache_size(user_cache)
+
+        if not self._persistent_area_snapshot_store is None:
+            try:
+                yield run_in_thread_pool(self._thread_pool, self._persistent_area_snapshot_store.save, user_cache.identity_key, all_areas)
+            except:
+                logging.error(logging.traceback.format_exc())
+
+        return all_areas
+
+    @defer.inlineCallbacks
+    def _load_or_fetch_all_areas(self, user_cache, fetch_all_areas):
+        if self._shared_area_snapshot_store is None:
+            return (yield fetch_all_areas())
+
+        # Only one worker process at a time fetches the areas of a user - the others wait for its result
+        (all_areas, user_cache.value.all_areas.shared_snapshot_modification_time) = \
+            yield self._shared_area_snapshot_store.load_or_fetch(user_cache.identity_key, fetch_all_areas)
+
+        return all_areas
+
+    @defer.inlineCallbacks
+    def _load_persisted_areas(self, user_cache):
+        """
+        Returns a Deferred which fires with a tuple of (areas, time they were fetched) for the given user. The areas
+        are those which another worker process already fetched or - failing that - those persisted before a restart,
+        or None if there are neither. The time is None for areas shared by another worker, which count as fetched
+        just now. Persisted areas are revalidated in the background.
+        """
+        if not self._shared_area_snapshot_store is None:
+            stored = yield self._shared_area_snapshot_store.load(user_cache.identity_key)
+
+            if not stored is None:
+                (all_areas, user_cache.value.all_areas.shared_snapshot_modification_time) = stored
+                return (all_areas, None)
+
+        # Persisted areas are only loaded once they're needed so they count towards the user cache budget
+        persisted = yield run_in_thread_pool(self._thread_pool, self._persistent_area_snapshot_store.load, user_cache.identity_key)
+
+        if persisted is None:
+            return (None, None)
+
+        (all_areas, persisted_time) = persisted
+
+        # Serve the persisted areas right away, but replace them with fresh ones as soon as possible
+        self._revalidate_persisted_areas(user_cache)
 
-        yield cache_cell.lock.run(setattr, cache_cell, 'value', None)
+        # Persisted times are wall clock times
+        return (all_areas, reactor.seconds() - max(0, time.time() - persisted_time))
+
+    def _revalidate_persisted_areas(self, user_cache):
+        # Holding the lock while fetching keeps a commit from expiring the areas before they're replaced with ones
+        # fetched before the commit - and lets concurrent misses wait for the fetch instead of repeating it
+        return user_cache.value.all_areas.lock.run(self._refetch_persisted_areas, user_cache)
+
+    @defer.inlineCallbacks
+    def _refetch_persisted_areas(self, user_cache):
+        cache_cell = user_cache.value.all_areas
+
+        try:
+            all_areas = yield self._load_or_fetch_all_areas(user_cache, partial(self._fetch_all_areas, user_cache, BACKGROUND))
+        except UpstreamOverloadedError:
+            # The persisted areas will simply expire - and be fetched again - like any other cached areas
+            logging.warning("Skipped revalidating persisted areas since FarmOS is overloaded")
+            return
+        except:
+            logging.error(logging.traceback.format_exc())
+
+            # The credentials may no longer be valid so stop serving anything fetched with them
+            yield run_in_thread_pool(self._thread_pool, self._persistent_area_snapshot_store.delete, user_cache.identity_key)
+            cache_cell.value = None
+            self._user_caches.discard(user_cache)
+            return
+
+        yield self._update_all_areas_cache_cell(user_cache, all_areas)
+
+    @defer.inlineCallbacks
+    def _refresh_committed_areas(self, user_cache, changed_tids, deleted_tids, committed_extents):
+        """
+        Replaces the changed areas among the cached areas of the given user with the areas read again from FarmOS
+        and drops the deleted ones - rather than fetching all the areas again - or expires the cached areas if
+        that's not possible.
+        """
+        if not changed_tids and not deleted_tids:
+            return
+
+        cache_cell = user_cache.value.all_areas
+
+        yield self._expire_stored_areas(user_cache)
+
+        @defer.inlineCallbacks
+        def refresh():
+            area_snapshot = cache_cell.value
+
+            if area_snapshot is None:
+                self._expire_all_areas_cache_cell(user_cache, committed_extents)
+                return
+
+            try:
+                changed_areas = yield user_cache.value.farm_os_client.area.get_by_ids(changed_tids)
+            except:
+                logging.error(logging.traceback.format_exc())
+                self._expire_all_areas_cache_cell(user_cache, committed_extents)
+                return
+
+            committed_tids = set(changed_tids) | set(deleted_tids)
+            all_areas = [area for area in area_snapshot if not area.tid in committed_tids] + changed_areas
+
+            # The other areas are only as fresh as before
+            yield self._update_all_areas_cache_cell(user_cache, all_areas, fetched_time=cache_cell.fetched_time, loaded_time=cache_cell.loaded_time)
+
+            # The shared areas were just expired - so they don't replace these until another worker stores new ones
+            cache_cell.shared_snapshot_modification_time = None
+
+        yield cache_cell.lock.run(refresh)
+
+    @defer.inlineCallbacks
+    def _expire_all_areas_cache(self, user_cache, committed_extents=()):
+        yield self._expire_stored_areas(user_cache)
+
+        yield user_cache.value.all_areas.lock.run(self._expire_all_areas_cache_cell, user_cache, committed_extents)
+
+    @defer.inlineCallbacks
+    def _expire_stored_areas(self, user_cache):
+        if not self._shared_area_snapshot_store is None:
+            self._shared_area_snapshot_store.expire(user_cache.identity_key)
+
+        # Otherwise the areas from before the commit would be served again after a restart
+        if not self._persistent_area_snapshot_store is None:
+            try:
+                yield run_in_thread_pool(self._thread_pool, self._persistent_area_snapshot_store.delete, user_cache.identity_key)
+            except:
+                logging.error(logging.traceback.format_exc())
+
+    def _expire_all_areas_cache_cell(self, user_cache, committed_extents):
+        cache_cell = user_cache.value.all_areas
+
+        cache_cell.value = None
+        self._user_caches.update_size(user_cache, user_cache.value.http_cache_size)
+
+        # Keep serving extents without a reload by growing them to include committed geometries. They may
+        # be larger than necessary after deletions until the areas are next fetched.
+        if not cache_cell.extents is None:
+            cache_cell.extents = _merge_layer_extents(cache_cell.extents, committed_extents)
+
+
+def _shield_from_cancellation(d):
+    shielded = defer.Deferred()
+
+    def complete(result):
+        if not shielded.called:
+            if isinstance(result, failure.Failure):
+                shielded.errback(result)
+            else:
+                shielded.callback(result)
+
+    d.addBoth(complete)
+
+    return shielded
+
+
+def _geometry_extent(geometry):
+    (min_x, max_x, min_y, max_y) = geometry.GetEnvelope()
+
+    return (min_x, min_y, max_x, max_y)
+
+
+def _with_approximate_features_size(layer_features):
+    def feature_size(feature):
+        return len(feature.feature_id) + feature.geometry.WkbSize() + sum(len(str(v)) for v in feature.field_data.values())
+
+    return (layer_features, sum(map(feature_size, layer_features)))
+
+
+def _layer_extents_by_name(layer_extents):
+    return {'farm_os_features_' + layer_type: layer_extents[layer_type.replace('_', '')]
+            for layer_type in LAYER_TYPES if layer_type.replace('_', '') in layer_extents}
+
+def _merge_layer_extents(layer_extents, extents_to_merge):
+    merged_layer_extents = dict(layer_extents)
+
+    for geojson_type, (min_x, min_y, max_x, max_y) in extents_to_merge:
+        existing_extent = merged_layer_extents.get(geojson_type, None)
+
+        if not existing_extent is None:
+            min_x, min_y = min(min_x, existing_extent[0]), min(min_y, existing_extent[1])
+            max_x, max_y = max(max_x, existing_extent[2]), max(max_y, existing_extent[3])
+
+        merged_layer_extents[geojson_type] = (min_x, min_y, max_x, max_y)
+
+    return merged_layer_extents
+
+
+def _create_spatial_reference(srs):
+    spatial_reference = osr.SpatialReference()
+    spatial_reference.SetFromUserInput(srs)
+
+    # GDAL >= 3 honors the authority axis order (lat/long for EPSG:4326) by default, but FarmOS stores and
+    # the WFS layers serve long/lat ordered coordinates
+    if hasattr(spatial_reference, 'SetAxisMappingStrategy'):
+        spatial_reference.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    return spatial_reference
 
 
 def main(reactor):
     parser = argparse.ArgumentParser()
     parser.add_argument("--farm-os-url", help="The url for connecting to FarmOS", type=str, default='http://localhost:80')
     parser.add_argument("--proxy-spec", help="The specification for hosting the proxy port", type=str, default='tcp:5707')
+    parser.add_argument("--supported-srs", help="Comma separated spatial reference systems which features can be requested in via SRSNAME", type=str, default=','.join(DEFAULT_SUPPORTED_SRS))
+    parser.add_argument("--simplification-tolerances", help="Comma separated tolerances (in degrees) of the simplified geometry levels of detail served to clients requesting them with the SIMPLIFY parameter. Level of detail simplification is disabled when empty", type=str, default=','.join(map(str, DEFAULT_SIMPLIFICATION_TOLERANCES)))
+    parser.add_argument("--worker-threads", help="The maximum number of threads used for CPU-bound geometry and XML processing", type=int, default=DEFAULT_THREAD_POOL_SIZE)
+    parser.add_argument("--workers", help="The number of worker processes serving the proxy port - which split the FarmOS request limits between them. Values greater than one require a 'tcp:' proxy spec", type=int, default=1)
+    parser.add_argument("--inherited-fd", help=argparse.SUPPRESS, type=int, default=None)
+    parser.add_argument("--shared-area-snapshot-dir", help=argparse.SUPPRESS, type=str, default=None)
+    parser.add_argument("--warm-credentials-file", help="Path of a file with 'user:password' lines for FarmOS accounts whose areas should be fetched at startup and kept cached", type=str, default=None)
+    parser.add_argument("--session-store-dir", help="Path of a directory to persist FarmOS sessions in so they can be reused after restarts", type=str, default=None)
+    parser.add_argument("--farm-os-http-cache-size", help="The number of FarmOS responses per user to revalidate with conditional requests (using ETag/Last-Modified) instead of downloading them again. Disabled when 0", type=int, default=0)
+    parser.add_argument("--farm-os-max-concurrency", help="The maximum number of concurrent requests to FarmOS across all users", type=int, default=DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument("--farm-os-max-queued", help="The maximum number of requests waiting to be sent to FarmOS. Requests beyond it are rejected with '503 Service Unavailable'", type=int, default=DEFAULT_MAX_QUEUED)
+    parser.add_argument("--farm-os-request-timeout", help="The number of seconds after which requests to FarmOS are abandoned. Disabled when 0", type=float, default=DEFAULT_REQUEST_TIMEOUT_SECONDS)
+    parser.add_argument("--farm-os-hedging-percentile", help="The latency percentile of recent reads from FarmOS after which a slow read is sent again - using whichever response arrives first. Disabled when 0", type=float, default=0)
+    parser.add_argument("--user-cache-max-megabytes", help="The approximate memory budget for caching the areas and features of all users. The least recently used users are evicted beyond it", type=int, default=DEFAULT_USER_CACHE_MAX_MEGABYTES)
+    parser.add_argument("--slow-request-seconds", help="Requests taking longer than this many seconds are logged with a breakdown of where the time went. Disabled when 0", type=float, default=DEFAULT_SLOW_REQUEST_SECONDS)
+    parser.add_argument("--profile-dir", help="Path of a directory to write profiles to. Sending SIGUSR2 to the proxy starts a profile", type=str, default=tempfile.gettempdir())
+    parser.add_argument("--profile-seconds", help="The maximum number of seconds a profile runs for", type=float, default=DEFAULT_PROFILE_SECONDS)
+    parser.add_argument("--profile-requests", help="The number of WFS requests after which a profile ends - if it doesn't run out of time first. Unlimited when 0", type=int, default=0)
+    parser.add_argument("--disable-metrics", help="Don't serve Prometheus metrics at /metrics", action='store_true')
+    parser.add_argument("--persistent-area-snapshot-path", help="Path of a SQLite database to persist fetched areas in so they can be served right away after restarts", type=str, default=None)
     args = parser.parse_args()
 
     log.startLogging(sys.stdout)
 
+    # The stdlib logging output would otherwise be limited to warnings - startLogging has redirected sys.stdout to the
+    # Twisted log so it ends up timestamped alongside everything else
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, format='%(levelname)s: %(message)s')
+
+    if args.workers > 1:
+        return _run_worker_processes(reactor, args)
+
+    identity_secret = os.environ.get(IDENTITY_SECRET_ENV, '').encode('utf-8')
+
+    persistent_area_snapshot_store = None
+
+    if args.persistent_area_snapshot_path:
+        persistent_area_snapshot_store = PersistentAreaSnapshotStore(args.persistent_area_snapshot_path, PERSISTENT_AREAS_MAX_AGE_SECONDS)
+
+        # Persisted areas are only useful if their keys can be derived again after a restart
+        identity_secret = persistent_area_snapshot_store.secret
+
     application = service.Application('FarmOsAreaFeatureProxy', uid=1, gid=1)
 
     service_collection = service.IServiceCollection(application)
 
-    site = server.Site(WfsResource(FarmOsProxyFeatureServer(args.farm_os_url)))
+    thread_pool = create_thread_pool(reactor, args.worker_threads)
+
+    shared_area_snapshot_store = None
+
+    if args.shared_area_snapshot_dir:
+        shared_area_snapshot_store = SharedAreaSnapshotStore(args.shared_area_snapshot_dir, AREAS_CACHE_SECONDS, reactor=reactor, thread_pool=thread_pool)
+
+    feature_server = FarmOsProxyFeatureServer(args.farm_os_url,
+                                              supported_srs=[srs.strip() for srs in args.supported_srs.split(',') if srs.strip()],
+                                              simplification_tolerances=[float(tolerance) for tolerance in args.simplification_tolerances.split(',') if tolerance.strip()],
+                                              thread_pool=thread_pool,
+                                              identity_secret=identity_secret,
+                                              shared_area_snapshot_store=shared_area_snapshot_store,
+                                              persistent_area_snapshot_store=persistent_area_snapshot_store,
+                                              session_store=TxDrupalSessionStore(args.session_store_dir) if args.session_store_dir else None,
+                                              user_cache_max_bytes=args.user_cache_max_megabytes * 1024 * 1024,
+                                              farm_os_http_cache_size=args.farm_os_http_cache_size,
+                                              upstream_scheduler=UpstreamScheduler(max_concurrency=args.farm_os_max_concurrency, max_queued=args.farm_os_max_queued),
+                                              farm_os_request_timeout_seconds=args.farm_os_request_timeout,
+                                              farm_os_hedging_percentile=args.farm_os_hedging_percentile)
+
+    log_geometry_backend()
+
+    task.LoopingCall(feature_server.log_user_cache_stats).start(USER_CACHE_STATS_LOG_SECONDS, now=False)
+
+    if args.warm_credentials_file:
+        for (user, password) in _read_credentials_file(args.warm_credentials_file):
+            reactor.callWhenRunning(feature_server.keep_warm, user, password)
+
+    metrics_resource = None
+
+    if not args.disable_metrics:
+        metrics.monitor_reactor_lag(reactor)
+        metrics_resource = metrics.MetricsResource(metrics.REGISTRY)
+
+    profiler = SamplingProfiler(reactor, args.profile_dir, max_seconds=args.profile_seconds, max_requests=args.profile_requests or None)
+    profiler.install_signal_handler(PROFILE_SIGNAL)
+
+    site = server.Site(WfsResource(feature_server, thread_pool=thread_pool, metrics_resource=metrics_resource,
+                                   slow_request_seconds=args.slow_request_seconds, profiler=profiler))
+
+    if not args.inherited_fd is None:
+        reactor.adoptStreamPort(args.inherited_fd, _socket_family(args.inherited_fd), site)
+        reactor.run()
+        return
 
     svc = strports.service(args.proxy_spec, site)
     svc.setServiceParent(service_collection)
@@ -246,5 +992,149 @@ def main(reactor):
     finally:
         svc.stopService()
 
+def _read_credentials_file(path):
+    with open(path, 'rb') as credentials_file:
+        for line in credentials_file:
+            line = line.strip()
+
+            if not line or line.startswith(b'#'):
+                continue
+
+            (user, _separator, password) = line.partition(b':')
+
+            yield (user, password)
+
+
+class _WorkerProcessProtocol(protocol.ProcessProtocol):
+    def __init__(self, on_ended):
+        self._on_ended = on_ended
+        self._pid = None
+
+    def connectionMade(self):
+        # The transport forgets the pid once the process ended
+        self._pid = self.transport.pid
+
+    def processEnded(self, reason):
+        logging.error("Worker process {} ended: {}".format(self._pid, reason.value))
+
+        self._on_ended(self)
+
+
+def _run_worker_processes(reactor, args):
+    (port, interface, backlog) = _parse_tcp_proxy_spec(args.proxy_spec)
+
+    # Bind the listening socket once here and let all the workers accept connections from it
+    listening_socket = socket.socket(socket.AF_INET6 if ':' in interface else socket.AF_INET, socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listening_socket.bind((interface, port))
+    listening_socket.listen(backlog)
+    listening_socket.setblocking(False)
+
+    listening_fd = listening_socket.fileno()
+
+    shared_area_snapshot_dir = tempfile.mkdtemp(prefix='fosafp-areas-')
+
+    worker_env = dict(os.environ)
+    worker_env[IDENTITY_SECRET_ENV] = secrets.token_hex(32)
+
+    # Later arguments take precedence so the workers are started with the same options as this process - except for
+    # the FarmOS request limits which are split between them
+    worker_args = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + [
+        '--workers=1',
+        '--inherited-fd={}'.format(listening_fd),
+        '--shared-area-snapshot-dir={}'.format(shared_area_snapshot_dir),
+        '--farm-os-max-concurrency={}'.format(max(1, args.farm_os_max_concurrency // args.workers)),
+        '--farm-os-max-queued={}'.format(max(1, args.farm_os_max_queued // args.workers)),
+    ]
+
+    worker_processes = {}
+    """Worker processes by their slot"""
+
+    pending_restarts = {}
+    """Delayed calls starting a worker again by its slot"""
+
+    restart_delays = {}
+    """Delays before starting a worker again by its slot"""
+
+    def start_worker(slot):
+        pending_restarts.pop(slot, None)
+
+        worker_process = reactor.spawnProcess(_WorkerProcessProtocol(partial(worker_ended, slot, reactor.seconds())),
+                                              sys.executable, worker_args, env=worker_env,
+                                              childFDs={0: 0, 1: 1, 2: 2, listening_fd: listening_fd})
+
+        worker_processes[slot] = worker_process
+
+    def worker_ended(slot, started_time, _worker_process_protocol):
+        worker_processes.pop(slot, None)
+
+        if stopping:
+            return
+
+        if slot in restart_delays and reactor.seconds() - started_time < WORKER_RESTART_MAX_SECONDS:
+            restart_delays[slot] = min(restart_delays[slot] * 2, WORKER_RESTART_MAX_SECONDS)
+        else:
+            restart_delays[slot] = WORKER_RESTART_MIN_SECONDS
+
+        logging.warning("Starting worker process {} again in {} seconds".format(slot, restart_delays[slot]))
+
+        pending_restarts[slot] = reactor.callLater(restart_delays[slot], start_worker, slot)
+
+    stopping = False
+
+    for slot in range(args.workers):
+        start_worker(slot)
+
+    def stop_workers():
+        nonlocal stopping
+        stopping = True
+
+        for pending_restart in pending_restarts.values():
+            pending_restart.cancel()
+
+        for worker_process in worker_processes.values():
+            try:
+                worker_process.signalProcess('TERM')
+            except error.ProcessExitedAlready:
+                pass
+
+    reactor.addSystemEventTrigger('before', 'shutdown', stop_workers)
+
+    def profile_workers():
+        for worker_process in worker_processes.values():
+            try:
+                worker_process.signalProcess(PROFILE_SIGNAL)
+            except error.ProcessExitedAlready:
+                pass
+
+    signal.signal(PROFILE_SIGNAL, lambda _signal_number, _frame: reactor.callFromThread(profile_workers))
+
+    try:
+        reactor.run()
+    finally:
+        listening_socket.close()
+        shutil.rmtree(shared_area_snapshot_dir, ignore_errors=True)
+
+def _parse_tcp_proxy_spec(proxy_spec):
+    # Colons in strports descriptions - such as those of IPv6 interfaces - are escaped with a backslash
+    (endpoint_type, port, *endpoint_options) = [part.replace('\\:', ':') for part in re.split(r'(?<!\\):', proxy_spec)]
+
+    if endpoint_type != 'tcp':
+        raise ValueError("Multiple workers are only supported with a 'tcp:' proxy spec. Got: {!r}".format(proxy_spec))
+
+    endpoint_options = dict(option.split('=', 1) for option in endpoint_options)
+
+    return (int(port), endpoint_options.get('interface', ''), int(endpoint_options.get('backlog', 50)))
+
+def _socket_family(fd):
+    inherited_socket = socket.socket(fileno=fd)
+
+    try:
+        return inherited_socket.family
+    finally:
+        # Leave the file descriptor open for the reactor to adopt
+        inherited_socket.detach()
+
+
 if __name__ == "__main__":
     main(reactor)
@@ -0,0 +1,158 @@
+#!/bin/env python3
+
+import math, re
+
+from osgeo import ogr
+from lxml import etree
+
+
+GML_NAMESPACE = "http://www.opengis.net/gml"
+
+_POINT_TAG = "{%s}Point" % GML_NAMESPACE
+_LINE_STRING_TAG = "{%s}LineString" % GML_NAMESPACE
+_POLYGON_TAG = "{%s}Polygon" % GML_NAMESPACE
+_OUTER_BOUNDARY_TAG = "{%s}outerBoundaryIs" % GML_NAMESPACE
+_INNER_BOUNDARY_TAG = "{%s}innerBoundaryIs" % GML_NAMESPACE
+_LINEAR_RING_TAG = "{%s}LinearRing" % GML_NAMESPACE
+_COORDINATES_TAG = "{%s}coordinates" % GML_NAMESPACE
+
+# Plain decimal numbers - anything else Python's float() accepts (e.g. '1_0', 'nan', 'inf') is left to OGR
+_NUMBER_PATTERN = re.compile(r'^[+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?$')
+
+
+class WktGeometry(object):
+    """
+    Minimal stand-in for an C{osgeo.ogr.Geometry} which already knows its WKT representation. Provides just the
+    parts of the OGR geometry api needed to commit a feature.
+    """
+
+    def __init__(self, wkt, coordinates):
+        self._wkt = wkt
+        self._coordinates = coordinates
+
+    def ExportToWkt(self):
+        return self._wkt
+
+    def GetEnvelope(self):
+        xs = [coordinate[0] for coordinate in self._coordinates]
+        ys = [coordinate[1] for coordinate in self._coordinates]
+
+        return (min(xs), max(xs), min(ys), max(ys))
+
+
+def read_gml2_geometry(element):
+    """
+    Returns the geometry described by the given GML geometry element. GML2 points, line strings and polygons
+    using gml:coordinates are read directly into a L{WktGeometry}. Anything else is handed to OGR and returned as
+    an C{osgeo.ogr.Geometry}. Raises ValueError for unreadable geometries and those with non-finite coordinates.
+    """
+    geometry = _read_simple_gml2_geometry(element)
+
+    if not geometry is None:
+        return geometry
+
+    geometry = ogr.CreateGeometryFromGML(etree.tostring(element).decode("utf-8"))
+
+    if geometry is None:
+        raise ValueError("Unreadable GML geometry: {}".format(etree.QName(element.tag).localname))
+
+    if not all(map(math.isfinite, geometry.GetEnvelope())):
+        raise ValueError("GML geometry with non-finite coordinates: {}".format(etree.QName(element.tag).localname))
+
+    return geometry
+
+
+def _read_simple_gml2_geometry(element):
+    if element.tag == _POINT_TAG:
+        coordinates = _read_coordinates(element)
+
+        if coordinates is None or len(coordinates) != 1:
+            return None
+
+        return WktGeometry("POINT ({})".format(_format_coordinate(coordinates[0])), coordinates)
+
+    if element.tag == _LINE_STRING_TAG:
+        coordinates = _read_coordinates(element)
+
+        if coordinates is None or len(coordinates) < 2:
+            return None
+
+        return WktGeometry("LINESTRING {}".format(_format_coordinates(coordinates)), coordinates)
+
+    if element.tag == _POLYGON_TAG:
+        rings = []
+
+        for boundary in element.iterchildren():
+            if not boundary.tag in (_OUTER_BOUNDARY_TAG, _INNER_BOUNDARY_TAG) or (boundary.tag == _OUTER_BOUNDARY_TAG) != (not rings):
+                return None
+
+            linear_rings = list(boundary.iterchildren())
+
+            if len(linear_rings) != 1 or linear_rings[0].tag != _LINEAR_RING_TAG:
+                return None
+
+            coordinates = _read_coordinates(linear_rings[0])
+
+            if coordinates is None or len(coordinates) < 4 or coordinates[0] != coordinates[-1]:
+                return None
+
+            rings.append(coordinates)
+
+        # OGR doesn't write WKT mixing 2D and 3D rings either - let it decide what such a polygon means
+        if not rings or len({len(ring[0]) for ring in rings}) != 1:
+            return None
+
+        return WktGeometry("POLYGON ({})".format(', '.join(map(_format_coordinates, rings))), rings[0])
+
+    return None
+
+
+def _read_coordinates(element):
+    """
+    Returns the tuples of gml:coordinates - the only child of the given element - as lists of floats or None if
+    they aren't all consistently 2D or 3D plain decimal numbers. Raises ValueError for numbers which aren't finite.
+    """
+    children = list(element.iterchildren())
+
+    if len(children) != 1 or children[0].tag != _COORDINATES_TAG:
+        return None
+
+    coordinates_element = children[0]
+
+    decimal = coordinates_element.get('decimal', '.')
+    cs = coordinates_element.get('cs', ',')
+    ts = coordinates_element.get('ts', ' ')
+
+    text = coordinates_element.text or ''
+
+    # Tuples may be separated by any whitespace when using the default tuple separator
+    tuples = text.split() if ts == ' ' else text.strip().split(ts)
+
+    coordinates = []
+
+    for t in tuples:
+        coordinate = [n.strip().replace(decimal, '.') if decimal != '.' else n.strip() for n in t.split(cs)]
+
+        if not len(coordinate) in (2, 3) or (coordinates and len(coordinate) != len(coordinates[0])):
+            return None
+
+        if not all(_NUMBER_PATTERN.match(n) for n in coordinate):
+            return None
+
+        coordinate = [float(n) for n in coordinate]
+
+        if not all(map(math.isfinite, coordinate)):
+            raise ValueError("GML coordinates out of range: {!r}".format(t))
+
+        coordinates.append(coordinate)
+
+    return coordinates
+
+
+def _format_coordinate(coordinate):
+    # Normalized rather than copied from the request so only plain numbers end up in the WKT
+    return ' '.join(map(repr, coordinate))
+
+
+def _format_coordinates(coordinates):
+    return "({})".format(', '.join(map(_format_coordinate, coordinates)))
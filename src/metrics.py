@@ -0,0 +1,226 @@
+#!/bin/env python3
+
+import bisect, math
+
+from twisted.internet import task
+from twisted.web.resource import Resource
+
+
+PROMETHEUS_TEXT_MIMETYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DEFAULT_SIZE_BUCKETS = (1024, 4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024)
+DEFAULT_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+REACTOR_LAG_SAMPLE_SECONDS = 1
+
+
+class MetricsRegistry(object):
+    """
+    Collects metrics and renders them in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self):
+        lines = []
+
+        for metric in self._metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.metric_type))
+            lines.extend(metric.render_samples())
+
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class _Metric(object):
+    def __init__(self, name, documentation, label_names):
+        self.name = name
+        self.documentation = documentation
+        self._label_names = tuple(label_names)
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self._label_names):
+            raise ValueError("Metric {} requires the labels {}, got {}".format(self.name, self._label_names, tuple(labels)))
+
+        return tuple(str(labels[label_name]) for label_name in self._label_names)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self._label_names, key)) + list(extra)
+
+        if not pairs:
+            return ''
+
+        return '{' + ','.join('{}="{}"'.format(k, _escape_label_value(v)) for (k, v) in pairs) + '}'
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render_samples(self):
+        for (key, value) in sorted(self._values.items()):
+            yield "{}{} {}".format(self.name, self._format_labels(key), _format_value(value))
+
+
+class Gauge(_Metric):
+    """
+    Gauge which is either set explicitly or - with set_function - computed whenever the metrics are rendered.
+    """
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, label_names):
+        super().__init__(name, documentation, label_names)
+        self._function = None
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def set_function(self, fn):
+        """
+        Makes this gauge render the value returned by fn. Only supported for gauges without labels.
+        """
+        self._function = fn
+
+    def render_samples(self):
+        values = self._values if self._function is None else {(): self._function()}
+
+        for (key, value) in sorted(values.items()):
+            yield "{}{} {}".format(self.name, self._format_labels(key), _format_value(value))
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names, buckets):
+        super().__init__(name, documentation, label_names)
+        self._buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+
+        observations = self._values.get(key, None)
+
+        if observations is None:
+            # Bucket counts - with a final +Inf bucket - followed by the sum of all observations
+            observations = self._values[key] = [0] * (len(self._buckets) + 1) + [0]
+
+        observations[bisect.bisect_left(self._buckets, value)] += 1
+        observations[-1] += value
+
+    def render_samples(self):
+        for (key, observations) in sorted(self._values.items()):
+            cumulative_count = 0
+
+            for (upper_bound, count) in zip(self._buckets + (math.inf,), observations):
+                cumulative_count += count
+                yield "{}_bucket{} {}".format(self.name, self._format_labels(key, (('le', _format_value(upper_bound)),)), cumulative_count)
+
+            yield "{}_sum{} {}".format(self.name, self._format_labels(key), _format_value(observations[-1]))
+            yield "{}_count{} {}".format(self.name, self._format_labels(key), cumulative_count)
+
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, registry):
+        super().__init__()
+        self._registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', PROMETHEUS_TEXT_MIMETYPE)
+        return self._registry.render()
+
+
+def monitor_reactor_lag(reactor, sample_seconds=REACTOR_LAG_SAMPLE_SECONDS):
+    """
+    Periodically measures how late the reactor runs a timed call - a sign of the reactor thread being blocked - and
+    records it in the reactor_lag_seconds metrics. Returns the LoopingCall doing the measuring.
+    """
+    expected = [reactor.seconds() + sample_seconds]
+
+    def sample():
+        now = reactor.seconds()
+        lag = max(0, now - expected[0])
+
+        reactor_lag_seconds.set(lag)
+        reactor_lag_seconds_histogram.observe(lag)
+
+        expected[0] = now + sample_seconds
+
+    lag_loop = task.LoopingCall(sample)
+    lag_loop.clock = reactor
+    lag_loop.start(sample_seconds, now=False)
+
+    return lag_loop
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+
+    return str(value)
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+# The metrics of the proxy - shared by all its modules and served by a MetricsResource for REGISTRY
+REGISTRY = MetricsRegistry()
+
+wfs_request_seconds = REGISTRY.histogram('fosafp_wfs_request_seconds',
+    "Time to handle WFS requests by capability", ('capability',))
+wfs_response_bytes = REGISTRY.histogram('fosafp_wfs_response_bytes',
+    "Size of WFS response bodies by capability", ('capability',), buckets=DEFAULT_SIZE_BUCKETS)
+
+area_cache_lookups_total = REGISTRY.counter('fosafp_area_cache_lookups_total',
+    "Lookups of users' cached areas by result - hit, unchanged (extended after a change probe), or miss", ('result',))
+area_cache_refresh_seconds = REGISTRY.histogram('fosafp_area_cache_refresh_seconds',
+    "Time to fetch all of a user's areas from FarmOS by priority", ('priority',))
+area_cache_refresh_failures_total = REGISTRY.counter('fosafp_area_cache_refresh_failures_total',
+    "Failed fetches of all of a user's areas from FarmOS")
+user_cache_bytes = REGISTRY.gauge('fosafp_user_cache_bytes',
+    "Approximate memory used by the clients, areas, and features cached for all users")
+user_cache_entries = REGISTRY.gauge('fosafp_user_cache_entries',
+    "Number of users with cached data")
+
+farm_os_request_seconds = REGISTRY.histogram('fosafp_farm_os_request_seconds',
+    "Time until FarmOS responded to requests by method and status - 'error' when no response was received", ('method', 'status'))
+farm_os_list_pages = REGISTRY.histogram('fosafp_farm_os_list_pages',
+    "Number of pages fetched to list all entities of a type", ('entity_type',), buckets=DEFAULT_COUNT_BUCKETS)
+farm_os_logins_total = REGISTRY.counter('fosafp_farm_os_logins_total',
+    "Logins to FarmOS by outcome", ('outcome',))
+upstream_active_requests = REGISTRY.gauge('fosafp_upstream_active_requests',
+    "Requests to FarmOS currently running")
+upstream_queued_requests = REGISTRY.gauge('fosafp_upstream_queued_requests',
+    "Requests to FarmOS waiting for a free slot")
+
+commit_operations_total = REGISTRY.counter('fosafp_commit_operations_total',
+    "Feature operations committed to FarmOS by operation and outcome", ('operation', 'outcome'))
+
+reactor_lag_seconds = REGISTRY.gauge('fosafp_reactor_lag_seconds',
+    "Most recently measured delay of the reactor in running a timed call")
+reactor_lag_seconds_histogram = REGISTRY.histogram('fosafp_reactor_lag_observed_seconds',
+    "Measured delays of the reactor in running timed calls")
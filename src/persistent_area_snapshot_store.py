@@ -0,0 +1,125 @@
+#!/bin/env python3
+
+import os, json, time, logging, sqlite3, secrets, threading
+
+from osgeo import ogr
+
+
+class PersistentAreaSnapshotStore(object):
+    """
+    Persists the areas fetched from FarmOS in a SQLite database - with their geometries as WKB - so that they can
+    be served right away after the proxy is restarted.
+
+    All methods block on disk I/O so they should be called from a worker thread.
+    """
+
+    def __init__(self, path, max_age_seconds):
+        self._max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+
+        # The stored areas are only as public as the FarmOS site so keep them private to this user
+        if not os.path.exists(path):
+            os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+
+        with self._lock:
+            self._connection.executescript('''
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS area_snapshots (key TEXT PRIMARY KEY, fetched REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS areas (
+                    key TEXT NOT NULL REFERENCES area_snapshots(key) ON DELETE CASCADE,
+                    tid TEXT NOT NULL,
+                    changed TEXT,
+                    geo_type TEXT,
+                    geometry BLOB,
+                    record TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS areas_key ON areas (key);
+            ''')
+
+            self._connection.execute("INSERT OR IGNORE INTO settings (name, value) VALUES ('secret', ?)", (secrets.token_hex(32),))
+
+            self._connection.execute("DELETE FROM areas WHERE key IN (SELECT key FROM area_snapshots WHERE fetched < ?)", (time.time() - max_age_seconds,))
+            self._connection.execute("DELETE FROM area_snapshots WHERE fetched < ?", (time.time() - max_age_seconds,))
+
+    @property
+    def secret(self):
+        """
+        Secret which is stable across restarts for deriving the keys of stored areas from credentials.
+        """
+        with self._lock:
+            (secret,) = self._connection.execute("SELECT value FROM settings WHERE name = 'secret'").fetchone()
+
+        return secret.encode('utf-8')
+
+    def load(self, key):
+        """
+        Returns a tuple of (areas, time they were fetched) stored for the given key or None if there are none which
+        haven't exceeded the maximum age.
+        """
+        with self._lock:
+            snapshot = self._connection.execute("SELECT fetched FROM area_snapshots WHERE key = ? AND fetched >= ?",
+                                                (key, time.time() - self._max_age_seconds)).fetchone()
+
+            if snapshot is None:
+                return None
+
+            rows = self._connection.execute("SELECT geo_type, geometry, record FROM areas WHERE key = ? ORDER BY rowid", (key,)).fetchall()
+
+        areas = []
+
+        for (geo_type, geometry, record) in rows:
+            area = json.loads(record)
+
+            if not geometry is None:
+                area['geofield'] = [{'geo_type': geo_type, 'geom': ogr.CreateGeometryFromWkb(geometry).ExportToWkt()}]
+
+            areas.append(area)
+
+        return (areas, snapshot[0])
+
+    def save(self, key, areas):
+        rows = []
+
+        for area in areas:
+            record = dict(area)
+
+            geo_type = None
+            geometry = None
+
+            geofield = record.get('geofield', [])
+
+            if len(geofield) == 1 and geofield[0].get('geom'):
+                ogr_geometry = ogr.CreateGeometryFromWkt(geofield[0]['geom'])
+
+                # The area is fetched again when the persisted areas are revalidated
+                if ogr_geometry is None:
+                    logging.warning("Not persisting area {} with unreadable geometry".format(area.get('tid')))
+                    continue
+
+                record.pop('geofield')
+                geo_type = geofield[0].get('geo_type')
+                geometry = bytes(ogr_geometry.ExportToWkb())
+
+            rows.append((key, area.get('tid'), area.get('changed'), geo_type, geometry, json.dumps(record)))
+
+        with self._lock:
+            self._connection.execute("BEGIN")
+            try:
+                self._delete(key)
+                self._connection.execute("INSERT INTO area_snapshots (key, fetched) VALUES (?, ?)", (key, time.time()))
+                self._connection.executemany("INSERT INTO areas (key, tid, changed, geo_type, geometry, record) VALUES (?, ?, ?, ?, ?, ?)", rows)
+                self._connection.execute("COMMIT")
+            except:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+
+    def _delete(self, key):
+        self._connection.execute("DELETE FROM areas WHERE key = ?", (key,))
+        self._connection.execute("DELETE FROM area_snapshots WHERE key = ?", (key,))
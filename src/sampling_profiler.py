@@ -0,0 +1,145 @@
+#!/bin/env python3
+
+import os, sys, time, logging, threading
+from collections import Counter
+
+
+DEFAULT_PROFILE_SECONDS = 60
+DEFAULT_PROFILE_SAMPLE_SECONDS = 0.005
+
+PROFILE_SUMMARY_FUNCTIONS = 15
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stacks of all threads - the reactor thread and the thread pools alike - from a background thread
+    while a profile is running. Profiles end after a number of seconds or once a number of WFS requests finished,
+    whichever comes first, and are written to the output directory in collapsed stack format (one
+    'thread;outermost frame;...;innermost frame count' line per distinct stack) as used by flame graph tools.
+
+    Unlike cProfile, sampling sees every thread and its overhead doesn't depend on how many calls are made.
+    """
+
+    def __init__(self, reactor, output_dir, max_seconds=DEFAULT_PROFILE_SECONDS, max_requests=None, sample_seconds=DEFAULT_PROFILE_SAMPLE_SECONDS):
+        self._reactor = reactor
+        self._output_dir = output_dir
+        self._max_seconds = max_seconds
+        self._max_requests = max_requests
+        self._sample_seconds = sample_seconds
+        self._stop_event = None
+        self._remaining_requests = None
+
+    @property
+    def running(self):
+        return not self._stop_event is None
+
+    def start(self):
+        """
+        Starts a profile unless one is already running. Must be called on the reactor thread.
+        """
+        if self.running:
+            logging.warning("Ignoring request to start profiling since a profile is already running")
+            return
+
+        self._stop_event = threading.Event()
+        self._remaining_requests = self._max_requests
+
+        logging.info("Profiling for {} seconds{}".format(self._max_seconds,
+            "" if self._max_requests is None else " or {} requests".format(self._max_requests)))
+
+        threading.Thread(target=self._sample, args=(self._stop_event,), name="FarmOsAreaFeatureProxyProfiler", daemon=True).start()
+
+    def stop(self):
+        """
+        Ends the running profile - if any - and writes it out. Must be called on the reactor thread.
+        """
+        if not self.running:
+            return
+
+        self._stop_event.set()
+        self._stop_event = None
+
+    def request_finished(self):
+        """
+        Counts a finished request towards the running profile's request limit. Must be called on the reactor thread.
+        """
+        if not self.running or self._remaining_requests is None:
+            return
+
+        self._remaining_requests -= 1
+
+        if self._remaining_requests <= 0:
+            self.stop()
+
+    def install_signal_handler(self, signal_number):
+        """
+        Starts a profile whenever the process receives the given signal - so only those able to signal the process
+        can profile it.
+        """
+        import signal
+
+        signal.signal(signal_number, lambda _signal_number, _frame: self._reactor.callFromThread(self.start))
+
+    def _sample(self, stop_event):
+        sampler_ident = threading.get_ident()
+        started = time.monotonic()
+        deadline = started + self._max_seconds
+
+        stacks = Counter()
+        sample_count = 0
+
+        while not stop_event.wait(self._sample_seconds):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+            for (thread_ident, frame) in sys._current_frames().items():
+                if thread_ident == sampler_ident:
+                    continue
+
+                stacks[_collapse_stack(thread_names.get(thread_ident, str(thread_ident)), frame)] += 1
+
+            sample_count += 1
+
+            if time.monotonic() >= deadline:
+                self._reactor.callFromThread(self._stop_if_current, stop_event)
+                break
+
+        try:
+            self._write_profile(stacks, sample_count, time.monotonic() - started)
+        except Exception:
+            logging.error(logging.traceback.format_exc())
+
+    def _stop_if_current(self, stop_event):
+        if self._stop_event is stop_event:
+            self.stop()
+
+    def _write_profile(self, stacks, sample_count, elapsed_seconds):
+        path = os.path.join(self._output_dir, "fosafp-profile-{}-{}.collapsed".format(os.getpid(), time.strftime("%Y%m%dT%H%M%S")))
+
+        with open(path, 'w', encoding='utf-8') as profile_file:
+            for (stack, count) in stacks.most_common():
+                profile_file.write("{} {}\n".format(stack, count))
+
+        # Functions by the number of samples a thread was running them itself - idle threads show up as waiting
+        self_counts = Counter()
+
+        for (stack, count) in stacks.items():
+            self_counts[stack.rsplit(';', 1)[-1]] += count
+
+        logging.info("Wrote profile of {} samples over {:.1f} seconds to {}. Most sampled functions:\n{}".format(
+            sample_count, elapsed_seconds, path,
+            '\n'.join("{:>8} {}".format(count, function) for (function, count) in self_counts.most_common(PROFILE_SUMMARY_FUNCTIONS))))
+
+
+def _collapse_stack(thread_name, frame):
+    functions = []
+
+    while not frame is None:
+        code = frame.f_code
+        functions.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+
+    functions.append(thread_name)
+    functions.reverse()
+
+    # Semicolons separate the frames of a collapsed stack
+    return ';'.join(function.replace(';', ':') for function in functions)
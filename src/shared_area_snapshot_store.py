@@ -0,0 +1,126 @@
+#!/bin/env python3
+
+import os, json, time, fcntl, tempfile
+
+from twisted.internet import defer, task
+
+from deferred_thread_pool import run_in_thread_pool
+
+
+FETCH_LOCK_POLL_SECONDS = 0.1
+
+
+class SharedAreaSnapshotStore(object):
+    """
+    Shares the areas fetched from FarmOS between the worker processes of a proxy via JSON files in a common
+    directory so that only one worker at a time fetches the areas for a given key. Workers share the files - not
+    memory - so each worker still parses and holds its own copy of the areas. Keys must not reveal the credentials
+    they were derived from.
+
+    Reading and writing the files happens in the given thread pool to keep it off the reactor thread.
+    """
+
+    def __init__(self, directory, max_age_seconds, reactor=None, thread_pool=None):
+        if reactor is None:
+            import twisted.internet
+            reactor = twisted.internet.reactor
+
+        self._directory = directory
+        self._max_age_seconds = max_age_seconds
+        self._reactor = reactor
+        self._thread_pool = thread_pool
+
+    def modification_time(self, key):
+        """
+        Returns the modification time of the areas stored for the given key or None if there are none.
+        """
+        try:
+            return os.stat(self._areas_path(key)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def load(self, key):
+        """
+        Returns a Deferred which fires with a tuple of (areas, modification time) loaded from this store or None if
+        there are no areas stored for the given key - without waiting for other workers fetching them.
+        """
+        return run_in_thread_pool(self._thread_pool, self._load, key)
+
+    @defer.inlineCallbacks
+    def load_or_fetch(self, key, fetch_areas):
+        """
+        Returns a Deferred which fires with a tuple of (areas, modification time) either loaded from this store or
+        fetched by calling fetch_areas and then stored for the other workers. The fetch lock is held while
+        fetching so that concurrent misses in other workers wait for the result instead of fetching it again.
+        """
+        stored = yield run_in_thread_pool(self._thread_pool, self._load, key)
+
+        if not stored is None:
+            return stored
+
+        lock_file = open(self._lock_path(key), 'a')
+        try:
+            while not _try_lock(lock_file):
+                yield task.deferLater(self._reactor, FETCH_LOCK_POLL_SECONDS, lambda: None)
+
+            try:
+                stored = yield run_in_thread_pool(self._thread_pool, self._load, key)
+
+                if not stored is None:
+                    return stored
+
+                areas = yield fetch_areas()
+
+                modification_time = yield run_in_thread_pool(self._thread_pool, self._store, key, areas)
+
+                return (areas, modification_time)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            lock_file.close()
+
+    def expire(self, key):
+        try:
+            os.unlink(self._areas_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _load(self, key):
+        try:
+            with open(self._areas_path(key), 'rb') as areas_file:
+                modification_time = os.fstat(areas_file.fileno()).st_mtime
+
+                if time.time() - modification_time > self._max_age_seconds:
+                    return None
+
+                return (json.loads(areas_file.read()), modification_time)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _store(self, key, areas):
+        (fd, temp_path) = tempfile.mkstemp(dir=self._directory, prefix='.' + key)
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(json.dumps(list(areas)).encode('utf-8'))
+
+            # Atomically replace any previous areas so readers never see a partial file
+            os.replace(temp_path, self._areas_path(key))
+        except:
+            os.unlink(temp_path)
+            raise
+
+        return os.stat(self._areas_path(key)).st_mtime
+
+    def _areas_path(self, key):
+        return os.path.join(self._directory, key + '.json')
+
+    def _lock_path(self, key):
+        return os.path.join(self._directory, key + '.lock')
+
+
+def _try_lock(lock_file):
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
@@ -0,0 +1,63 @@
+#!/bin/env python3
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class StageTimings(object):
+    """
+    Accumulates the wall clock time a single request spends in named stages - in the order the stages were first
+    entered. Stages may be entered repeatedly and may span yields to the reactor.
+    """
+
+    def __init__(self, clock):
+        self._clock = clock
+        self._started = clock.seconds()
+        self._durations = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        started = self._clock.seconds()
+        try:
+            yield
+        finally:
+            self._durations[name] = self._durations.get(name, 0) + self._clock.seconds() - started
+
+    def total_seconds(self):
+        return self._clock.seconds() - self._started
+
+    def durations(self):
+        """
+        Returns a list of (stage name, seconds) tuples - ending with the total time of the request so far.
+        """
+        return list(self._durations.items()) + [('total', self.total_seconds())]
+
+    def server_timing_header(self):
+        """
+        Returns the value of a Server-Timing header describing the stages.
+        """
+        return ', '.join('{};dur={:.1f}'.format(name, seconds * 1000) for (name, seconds) in self.durations())
+
+
+class _NoStageTimings(object):
+    @contextmanager
+    def stage(self, name):
+        yield
+
+
+NO_STAGE_TIMINGS = _NoStageTimings()
+"""Stand-in for work which isn't done on behalf of a request - e.g. keeping caches warm."""
+
+
+def stage_timings(request):
+    """
+    Returns the L{StageTimings} of the given request - starting them if this is the first call for the request.
+    """
+    timings = getattr(request, 'stage_timings', None)
+
+    if timings is None:
+        from twisted.internet import reactor
+
+        timings = request.stage_timings = StageTimings(reactor)
+
+    return timings
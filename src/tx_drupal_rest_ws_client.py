@@ -2,23 +2,50 @@
 
 from io import BytesIO
 
-from twisted.internet import reactor, task, defer
-from twisted.python import compat
+from twisted.internet import reactor, defer
+from twisted.python import compat, failure
 from twisted.web.client import Agent, CookieAgent, readBody, FileBodyProducer, HTTPConnectionPool
 from twisted.web.http_headers import Headers
 
 from urllib.parse import urlencode, urlparse, parse_qs
+from collections import deque
 from datetime import datetime, timezone, timedelta
+from http.cookiejar import Cookie
+
+from cachetools import LRUCache
+
+from coalesced_deferred import CoalescedDeferred
+from metrics import farm_os_request_seconds, farm_os_list_pages, farm_os_logins_total
+from upstream_scheduler import UpstreamOverloadedError, INTERACTIVE, BACKGROUND, BULK
+
+import os, warnings, json, logging, hmac, hashlib, secrets, math
+
+# Sessions are refreshed in the background this long before they expire
+SESSION_REFRESH_MARGIN = timedelta(minutes=5)
+
+# Deadline for each call - including any login it needs and reading the response - once it has been started
+DEFAULT_REQUEST_TIMEOUT_SECONDS = 60
+
+class TxDrupalRestWsResponseError(Exception):
+    """
+    Raised when Drupal answers a request with an unexpected HTTP status code.
+    """
+
+    def __init__(self, message, code):
+        super().__init__(message)
+
+        self.code = code
 
-import warnings, json
 
 class TxDrupalRestWsClient(object):
-    def __init__(self, drupal_url, user, password, reactor, tx_agent, cookie_jar, user_agent):
+    def __init__(self, drupal_url, user, password, reactor, agent, cookie_jar, user_agent, session_store=None, http_cache_size=0, upstream_scheduler=None,
+                 request_timeout_seconds=DEFAULT_REQUEST_TIMEOUT_SECONDS, hedging_latency_tracker=None):
         self._drupal_url = drupal_url
         self._user = user
         self._password = password
         self._reactor = reactor
-        self._tx_agent = tx_agent
+        self._agent = agent
+        self._tx_agent = CookieAgent(agent, cookie_jar)
         self._cookie_jar = cookie_jar
         self._user_agent = user_agent
 
@@ -27,9 +54,31 @@ class TxDrupalRestWsClient(object):
 
         self._session_lock = defer.DeferredLock()
         self._csrf_token = None
+        self._session_expiry = None
+
+        self._session_store = session_store
+        self._session_key = session_store.key_for(drupal_url, user, password) if session_store else None
+        self._session_restore_attempted = False
+        self._session_refresh_call = None
+        self._session_used_since_refresh = False
+
+        # Identical GETs which are in flight at the same time share a single request, by url
+        self._in_flight_gets = {}
+
+        # Opt-in cache of (ETag, Last-Modified, parsed JSON, body size) by url for revalidating GETs with conditional requests
+        self._http_cache = LRUCache(maxsize=http_cache_size) if http_cache_size else None
+
+        # Optionally shared with other clients to limit - and prioritize - the requests to the same Drupal site
+        self._upstream_scheduler = upstream_scheduler
+
+        self._request_timeout_seconds = request_timeout_seconds
+
+        # GETs are hedged - sent again if they take longer than usual - only when given a latency tracker
+        self._hedging_latency_tracker = hedging_latency_tracker
 
     @classmethod
-    def create(cls, drupal_url, user, password, reactor=None, cookie_jar=None, user_agent="TxDrupalRestWsClient"):
+    def create(cls, drupal_url, user, password, reactor=None, cookie_jar=None, user_agent="TxDrupalRestWsClient", session_store=None, http_cache_size=0,
+               upstream_scheduler=None, request_timeout_seconds=DEFAULT_REQUEST_TIMEOUT_SECONDS, hedging_latency_tracker=None):
         if cookie_jar is None:
             cookie_jar = compat.cookielib.CookieJar()
 
@@ -39,68 +88,194 @@ class TxDrupalRestWsClient(object):
 
         pool = HTTPConnectionPool(reactor)
 
-        tx_agent = CookieAgent(Agent(reactor, pool=pool), cookie_jar)
+        agent = Agent(reactor, pool=pool)
 
-        return cls(drupal_url, user, password, reactor, tx_agent, cookie_jar, user_agent)
+        return cls(drupal_url, user, password, reactor, agent, cookie_jar, user_agent, session_store=session_store, http_cache_size=http_cache_size,
+                   upstream_scheduler=upstream_scheduler, request_timeout_seconds=request_timeout_seconds, hedging_latency_tracker=hedging_latency_tracker)
+
+    def get_entity(self, entity_type, entity_id, priority=INTERACTIVE):
+        return self._coalesced_get_json(self.format_url('{entity_type}/{entity_id}.json', entity_type=entity_type, entity_id=entity_id),
+            "Failed to get entity: " + str(entity_id), priority)
 
     @defer.inlineCallbacks
-    def get_entity(self, entity_type, entity_id):
-        headers = yield self.get_authenticated_headers()
+    def get_entities(self, entity_type, filters, priority=INTERACTIVE):
+        raw_page = yield self._get_entities(entity_type, filters, priority)
 
-        response = yield self._tx_agent.request(b'GET', 
-            self.format_url('{entity_type}/{entity_id}.json', entity_type=entity_type, entity_id=entity_id),
-            headers, None)
+        return TxDrupalEntityPage(self, entity_type, filters, raw_page, priority=priority)
 
-        if response.code != 200:
-            raise Exception("Failed to get entity: " + entity_id)
+    def _get_entities(self, entity_type, filters, priority=INTERACTIVE):
+        return self._coalesced_get_json(self.format_url('{entity_type}.json', query_params=filters, entity_type=entity_type),
+            "Failed to get entities of type: " + entity_type, priority)
 
-        result = yield _read_body_no_warn(response)
+    def _coalesced_get_json(self, url, error_message, priority=INTERACTIVE):
+        '''
+        Returns a Deferred which fires with the parsed JSON body of a GET request for the given url. Callers must
+        treat the result as read-only since concurrent callers for the same url share it.
+        '''
+        coalesced_request = self._in_flight_gets.get(url, None)
 
-        return json.loads(result)
+        if coalesced_request is None:
+            d = self._schedule(priority, self._hedged_get_json, url, error_message)
 
-    @defer.inlineCallbacks
-    def get_entities(self, entity_type, filters):
-        raw_page = yield self._get_entities(entity_type, filters)
+            coalesced_request = CoalescedDeferred(d)
+
+            def forget_request(result):
+                self._in_flight_gets.pop(url, None)
+                return result
+
+            # Registered before the waiters are notified so that they can't join a request which already finished
+            d.addBoth(forget_request)
+            d.addBoth(coalesced_request.complete)
+
+            # The request may have finished synchronously
+            if not coalesced_request.completed:
+                self._in_flight_gets[url] = coalesced_request
+
+        return coalesced_request.wait()
+
+    def _hedged_get_json(self, url, error_message):
+        hedging_delay = None if self._hedging_latency_tracker is None else self._hedging_latency_tracker.threshold()
+
+        if hedging_delay is None:
+            return self._timed_get_json(url, error_message)
+
+        attempts = []
+
+        def cancel_attempts(_result):
+            if hedge_call.active():
+                hedge_call.cancel()
+
+            for attempt in list(attempts):
+                attempt.cancel()
+
+        result = defer.Deferred(cancel_attempts)
+
+        def complete_attempt(outcome, attempt):
+            attempts.remove(attempt)
+
+            # A failed attempt only fails the call if no other attempt can still succeed
+            if result.called or (isinstance(outcome, failure.Failure) and attempts):
+                return None
+
+            if isinstance(outcome, failure.Failure):
+                result.errback(outcome)
+            else:
+                result.callback(outcome)
+
+            # Abandon the slower attempt
+            cancel_attempts(None)
+
+        def start_attempt():
+            attempt = self._timed_get_json(url, error_message)
+            attempts.append(attempt)
+            attempt.addBoth(complete_attempt, attempt)
+
+        hedge_call = self._reactor.callLater(hedging_delay, start_attempt)
+
+        start_attempt()
+
+        return result
+
+    def _timed_get_json(self, url, error_message):
+        started = self._reactor.seconds()
+
+        d = self._get_json(url, error_message)
 
-        return TxDrupalEntityPage(self, entity_type, filters, raw_page)
+        if not self._hedging_latency_tracker is None:
+            def record_latency(result):
+                self._hedging_latency_tracker.record(self._reactor.seconds() - started)
+                return result
+
+            d.addCallback(record_latency)
+
+        return d
 
     @defer.inlineCallbacks
-    def _get_entities(self, entity_type, filters):
-        headers = yield self.get_authenticated_headers()
+    def _get_json(self, url, error_message):
+        cached = None if self._http_cache is None else self._http_cache.get(url, None)
+
+        conditional_headers = {}
+
+        if not cached is None:
+            (etag, last_modified, _cached_value, _cached_size) = cached
+
+            if etag:
+                conditional_headers['If-None-Match'] = [etag]
+            if last_modified:
+                conditional_headers['If-Modified-Since'] = [last_modified]
 
-        response = yield self._tx_agent.request(b'GET', 
-            self.format_url('{entity_type}.json', query_params=filters, entity_type=entity_type),
-            headers, None)
+        response = yield self._authenticated_request(b'GET', url, extra_headers=conditional_headers or None)
+
+        if response.code == 304 and not cached is None:
+            yield _read_body_no_warn(response)
+
+            # Unchanged so skip downloading and parsing the body again
+            return cached[2]
 
         if response.code != 200:
-            raise Exception("Failed to get entities of type: " + entity_type)
+            raise TxDrupalRestWsResponseError(error_message, response.code)
 
         result = yield _read_body_no_warn(response)
 
-        return json.loads(result)
+        value = json.loads(result)
+
+        if not self._http_cache is None:
+            etag = response.headers.getRawHeaders(b'ETag', [None])[0]
+            last_modified = response.headers.getRawHeaders(b'Last-Modified', [None])[0]
+
+            if etag or last_modified:
+                self._http_cache[url] = (etag, last_modified, value, len(result))
+            else:
+                self._http_cache.pop(url, None)
+
+        return value
+
+    @property
+    def http_cache_size(self):
+        """
+        Approximate size in bytes of the responses kept for revalidating GETs - measured by the size of their bodies.
+        """
+        if self._http_cache is None:
+            return 0
+
+        return sum(cached[3] for cached in self._http_cache.values())
+
+    def clear_http_cache(self):
+        if not self._http_cache is None:
+            self._http_cache.clear()
 
     @defer.inlineCallbacks
-    def get_all_entities(self, entity_type, filters):
+    def get_all_entities(self, entity_type, filters, priority=INTERACTIVE):
         all_entities = []
 
-        page = yield self.get_entities(entity_type, filters)
+        page = yield self.get_entities(entity_type, filters, priority)
+
+        page_count = 0
 
         while page:
             all_entities.extend(page)
+            page_count += 1
 
             page = yield page.next_page(forgetful=True)
 
+        farm_os_list_pages.observe(page_count, entity_type=entity_type)
+
         return TxDrupalEntityPage(self, entity_type, filters, {'list': all_entities})
 
-    @defer.inlineCallbacks
-    def create_entity(self, entity_type, record):
-        headers = yield self.get_authenticated_headers({'Content-Type': ['application/json']})
+    def create_entity(self, entity_type, record, priority=BULK):
+        return self._schedule(priority, self._create_entity, entity_type, record)
+
+    def update_entity(self, entity_type, entity_id, record, priority=BULK):
+        return self._schedule(priority, self._update_entity, entity_type, entity_id, record)
 
-        body = FileBodyProducer(BytesIO(json.dumps(record).encode('utf-8')))
+    def delete_entity(self, entity_type, entity_id, priority=BULK):
+        return self._schedule(priority, self._delete_entity, entity_type, entity_id)
 
-        response = yield self._tx_agent.request(b'POST', 
+    @defer.inlineCallbacks
+    def _create_entity(self, entity_type, record):
+        response = yield self._authenticated_request(b'POST',
             self.format_url('{entity_type}', entity_type=entity_type),
-            headers, body)
+            body=json.dumps(record).encode('utf-8'), extra_headers={'Content-Type': ['application/json']})
 
         result = yield _read_body_no_warn(response)
 
@@ -110,14 +285,10 @@ class TxDrupalRestWsClient(object):
         return json.loads(result)
 
     @defer.inlineCallbacks
-    def update_entity(self, entity_type, entity_id, record):
-        headers = yield self.get_authenticated_headers({'Content-Type': ['application/json']})
-
-        body = FileBodyProducer(BytesIO(json.dumps(record).encode('utf-8')))
-
-        response = yield self._tx_agent.request(b'PUT', 
+    def _update_entity(self, entity_type, entity_id, record):
+        response = yield self._authenticated_request(b'PUT',
             self.format_url('{entity_type}/{entity_id}', entity_type=entity_type, entity_id=entity_id),
-            headers, body)
+            body=json.dumps(record).encode('utf-8'), extra_headers={'Content-Type': ['application/json']})
 
         if response.code != 200:
             result = yield _read_body_no_warn(response)
@@ -125,12 +296,10 @@ class TxDrupalRestWsClient(object):
             raise Exception(" ".join(map(str, ("Failed to update entity of type", entity_type, response.code, result))))
 
     @defer.inlineCallbacks
-    def delete_entity(self, entity_type, entity_id):
-        headers = yield self.get_authenticated_headers({'Content-Type': ['application/json']})
-
-        response = yield self._tx_agent.request(b'DELETE',
+    def _delete_entity(self, entity_type, entity_id):
+        response = yield self._authenticated_request(b'DELETE',
             self.format_url('{entity_type}/{entity_id}', entity_type=entity_type, entity_id=entity_id),
-            headers, None)
+            extra_headers={'Content-Type': ['application/json']})
 
         if response.code != 200:
             result = yield _read_body_no_warn(response)
@@ -140,18 +309,97 @@ class TxDrupalRestWsClient(object):
     def agent(self):
         return self._tx_agent
 
+    def _schedule(self, priority, f, *args):
+        # The whole call - including reading the response body - occupies one of the upstream scheduler's slots
+        if self._upstream_scheduler is None:
+            return self._with_deadline(f, *args)
+
+        return self._upstream_scheduler.run(self._user, priority, self._with_deadline, f, *args)
+
+    def _with_deadline(self, f, *args):
+        d = defer.maybeDeferred(f, *args)
+
+        if self._request_timeout_seconds:
+            # Cancelled requests fail in various ways so always report timeouts as such
+            d.addTimeout(self._request_timeout_seconds, self._reactor, onTimeoutCancel=_timed_out)
+
+        return d
+
     def format_url(self, path_template, query_params=None, **kwargs):
         url = self._drupal_url + '/' + path_template.format(**kwargs)
 
         if query_params:
-            url += '?' + urlencode(query_params)
+            url += '?' + urlencode(query_params, doseq=True)
 
         return url.encode('utf-8')
 
+    @defer.inlineCallbacks
+    def _authenticated_request(self, method, url, body=None, extra_headers=None):
+        for attempt in range(2):
+            headers = yield self.get_authenticated_headers(extra_headers)
+
+            csrf_token = self._csrf_token
+
+            body_producer = None if body is None else FileBodyProducer(BytesIO(body))
+
+            response = yield self._request(method, url, headers, body_producer)
+
+            if not response.code in (401, 403) or attempt:
+                return response
+
+            # Requests which were rejected for lack of permission are not retried - only those rejected because the
+            # session ended server-side or the CSRF token was no longer accepted
+            if (yield self._is_session_accepted(csrf_token)):
+                return response
+
+            yield _read_body_no_warn(response)
+
+    @defer.inlineCallbacks
+    def _is_session_accepted(self, csrf_token):
+        '''
+        Returns a Deferred which fires with whether the current session is still valid and the given CSRF token is
+        still its token. Otherwise the token is replaced or - if the session has ended - the session is invalidated.
+        '''
+        # RestWS only hands out tokens to authenticated sessions
+        response = yield self._request(b'GET', self._session_token_url,
+            Headers({
+                'User-Agent': [self._user_agent]
+            }), None)
+
+        current_csrf_token = yield _read_body_no_warn(response)
+
+        if response.code != 200:
+            self._invalidate_session(csrf_token)
+            return False
+
+        if current_csrf_token == csrf_token:
+            return True
+
+        # Another request may have already replaced the rejected session
+        if self._csrf_token == csrf_token:
+            self._csrf_token = current_csrf_token
+
+            if self._session_store:
+                self._session_store.save(self._session_key, self._csrf_token, self._session_expiry, self._cookie_jar)
+
+        return False
+
+    def _request(self, method, url, headers, body_producer, agent=None):
+        started = self._reactor.seconds()
+
+        def record_latency(result):
+            status = result.code if not isinstance(result, failure.Failure) else 'error'
+            farm_os_request_seconds.observe(self._reactor.seconds() - started, method=method.decode('utf-8'), status=status)
+            return result
+
+        return (agent or self._tx_agent).request(method, url, headers, body_producer).addBoth(record_latency)
+
     @defer.inlineCallbacks
     def get_authenticated_headers(self, extra_headers=None):
         yield self._ensure_authenticated()
 
+        self._session_used_since_refresh = True
+
         header_values = {
             'User-Agent': [self._user_agent],
             'X-CSRF-Token': [self._csrf_token]
@@ -162,54 +410,161 @@ class TxDrupalRestWsClient(object):
 
         defer.returnValue(Headers(header_values))
 
+    def _is_session_valid(self):
+        return self._csrf_token is not None and datetime.now(timezone.utc) < self._session_expiry
+
+    def ensure_authenticated(self, priority=INTERACTIVE):
+        """
+        Returns a Deferred which fires once a session is available - logging in, like any other call, through the
+        upstream scheduler and with a deadline if necessary.
+        """
+        if self._is_session_valid():
+            return defer.succeed(True)
+
+        return self._schedule(priority, self._ensure_authenticated)
+
     @defer.inlineCallbacks
     def _ensure_authenticated(self):
         '''
         Returns a Deferred that will succeed when a RestWS session token is available or error if one cannot be retrieved.
         '''
-        if self._csrf_token is not None and datetime.now(timezone.utc) < self._session_expiry:
+        if self._is_session_valid():
             return defer.returnValue(True)
 
         yield self._session_lock.acquire()
         try:
-            if self._csrf_token is not None and datetime.now(timezone.utc) < self._session_expiry:
+            if self._is_session_valid():
                 return defer.returnValue(True)
 
-            login_args = {
-                'name': self._user,
-                'pass': self._password,
-                'form_id': 'user_login'
-            }
+            if self._restore_session():
+                return True
+
+            yield self._login()
+
+            return True
+        finally:
+            self._session_lock.release()
+
+    def _login(self):
+        def count_login(result):
+            farm_os_logins_total.inc(outcome='failure' if isinstance(result, failure.Failure) else 'success')
+            return result
 
-            body = FileBodyProducer(BytesIO(urlencode(login_args).encode('utf-8')))
+        return self._log_in().addBoth(count_login)
 
-            response = yield self._tx_agent.request(b'POST', self._login_url,
-                Headers({
-                    'User-Agent': [self._user_agent],
-                    'Content-Type': ["application/x-www-form-urlencoded"]
-                }), body)
+    @defer.inlineCallbacks
+    def _log_in(self):
+        # Drupal only lets anonymous sessions log in so start from scratch and only replace the cookies of the
+        # current session - which may still be in use - once the new one is ready
+        login_cookie_jar = compat.cookielib.CookieJar()
+        login_agent = CookieAgent(self._agent, login_cookie_jar)
+
+        login_args = {
+            'name': self._user,
+            'pass': self._password,
+            'form_id': 'user_login'
+        }
+
+        body = FileBodyProducer(BytesIO(urlencode(login_args).encode('utf-8')))
 
-            if response.code != 302 and response.code != 200:
-                result = yield _read_body_no_warn(response)
+        response = yield self._request(b'POST', self._login_url,
+            Headers({
+                'User-Agent': [self._user_agent],
+                'Content-Type': ["application/x-www-form-urlencoded"]
+            }), body, login_agent)
+
+        if response.code != 302 and response.code != 200:
+            result = yield _read_body_no_warn(response)
 
-                raise Exception("Login failed: " + str(response.code) + ": " + str(result))
+            raise Exception("Login failed: " + str(response.code) + ": " + str(result))
 
-            response = yield self._tx_agent.request(b'GET', self._session_token_url,
-                Headers({
-                    'User-Agent': [self._user_agent]
-                }), None)
+        response = yield self._request(b'GET', self._session_token_url,
+            Headers({
+                'User-Agent': [self._user_agent]
+            }), None, login_agent)
 
-            if response.code != 200:
-                result = yield _read_body_no_warn(response)
+        if response.code != 200:
+            result = yield _read_body_no_warn(response)
 
-                raise Exception("Session token retrieval failed: " + str(response.code) + ": " + str(result))
+            raise Exception("Session token retrieval failed: " + str(response.code) + ": " + str(result))
 
-            self._csrf_token = yield _read_body_no_warn(response)
-            self._session_expiry = self._derive_session_expiry_date_time()
+        csrf_token = yield _read_body_no_warn(response)
 
-            return True
-        finally:
-            self._session_lock.release()
+        self._cookie_jar.clear()
+
+        for cookie in login_cookie_jar:
+            self._cookie_jar.set_cookie(cookie)
+
+        self._csrf_token = csrf_token
+        self._session_expiry = self._derive_session_expiry_date_time()
+
+        if self._session_store:
+            self._session_store.save(self._session_key, self._csrf_token, self._session_expiry, self._cookie_jar)
+
+        self._schedule_session_refresh()
+
+    def _restore_session(self):
+        if not self._session_store or self._session_restore_attempted:
+            return False
+
+        self._session_restore_attempted = True
+
+        session = self._session_store.load(self._session_key)
+
+        if session is None:
+            return False
+
+        (csrf_token, session_expiry, cookies) = session
+
+        if datetime.now(timezone.utc) >= session_expiry:
+            return False
+
+        for cookie in cookies:
+            self._cookie_jar.set_cookie(cookie)
+
+        self._csrf_token = csrf_token
+        self._session_expiry = session_expiry
+
+        self._schedule_session_refresh()
+
+        return True
+
+    def _invalidate_session(self, csrf_token):
+        # Another request may have already replaced the rejected session
+        if self._csrf_token != csrf_token:
+            return
+
+        self._csrf_token = None
+
+        if self._session_store:
+            self._session_store.delete(self._session_key)
+
+    def _schedule_session_refresh(self):
+        if self._session_refresh_call and self._session_refresh_call.active():
+            self._session_refresh_call.cancel()
+
+        refresh_delay = (self._session_expiry - SESSION_REFRESH_MARGIN - datetime.now(timezone.utc)).total_seconds()
+
+        self._session_refresh_call = self._reactor.callLater(max(0, refresh_delay), self._refresh_session)
+
+    @defer.inlineCallbacks
+    def _refresh_session(self):
+        self._session_refresh_call = None
+
+        # Let sessions of idle clients expire rather than keeping them alive forever
+        if not self._session_used_since_refresh:
+            return
+
+        self._session_used_since_refresh = False
+
+        # Like any other login, refreshing goes through the upstream scheduler and has a deadline - but shouldn't hold up
+        # interactive requests
+        try:
+            yield self._schedule(BACKGROUND, self._session_lock.run, self._login)
+        except UpstreamOverloadedError:
+            logging.warning("Skipped refreshing the FarmOS session of {} since FarmOS is overloaded".format(self._user))
+        except:
+            logging.error(logging.traceback.format_exc())
 
     def _derive_session_expiry_date_time(self):
         session_cookie_expiries = []
@@ -236,17 +591,121 @@ class TxDrupalRestWsClient(object):
 
         return datetime.now(timezone.utc) + timedelta(hours=24)
 
+class TxDrupalSessionStore(object):
+    """
+    Persists RestWS sessions - cookies and CSRF tokens - in a directory so they can be reused across restarts.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+        self._directory = directory
+
+        secret_path = os.path.join(directory, 'secret')
+
+        if not os.path.exists(secret_path):
+            with os.fdopen(os.open(secret_path, os.O_CREAT | os.O_WRONLY, 0o600), 'w') as secret_file:
+                secret_file.write(secrets.token_hex(32))
+
+        with open(secret_path) as secret_file:
+            self._secret = secret_file.read().strip().encode('utf-8')
+
+    def key_for(self, drupal_url, user, password):
+        return hmac.new(self._secret, b'\0'.join(_to_bytes(v) for v in (drupal_url, user, password)), hashlib.sha256).hexdigest()
+
+    def load(self, key):
+        """
+        Returns a tuple of (csrf token, session expiry, cookies) or None if no session is stored for the given key.
+        """
+        try:
+            with open(self._session_path(key)) as session_file:
+                session = json.load(session_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        return (
+            session['csrf_token'].encode('utf-8'),
+            datetime.fromtimestamp(session['session_expiry'], timezone.utc),
+            [Cookie(**cookie) for cookie in session['cookies']],
+        )
+
+    def save(self, key, csrf_token, session_expiry, cookie_jar):
+        session = {
+            'csrf_token': csrf_token.decode('utf-8'),
+            'session_expiry': session_expiry.timestamp(),
+            'cookies': [_cookie_to_dict(cookie) for cookie in cookie_jar],
+        }
+
+        session_path = self._session_path(key)
+
+        with os.fdopen(os.open(session_path + '.tmp', os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600), 'w') as session_file:
+            json.dump(session, session_file)
+
+        os.replace(session_path + '.tmp', session_path)
+
+    def delete(self, key):
+        try:
+            os.unlink(self._session_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _session_path(self, key):
+        return os.path.join(self._directory, key + '.json')
+
+def _timed_out(_result, timeout):
+    return failure.Failure(defer.TimeoutError("Request took longer than {} seconds".format(timeout)))
+
+class TxDrupalLatencyTracker(object):
+    """
+    Tracks the latencies of recent GETs - optionally across clients for the same Drupal site - to decide when a
+    GET is taking unusually long and should be hedged.
+    """
+
+    def __init__(self, percentile=95, window_size=256, min_samples=20):
+        self._percentile = percentile
+        self._min_samples = min_samples
+        self._latencies = deque(maxlen=window_size)
+
+    def record(self, latency_seconds):
+        self._latencies.append(latency_seconds)
+
+    def threshold(self):
+        """
+        Returns the configured percentile of the recent latencies in seconds or None if too few are known yet.
+        """
+        if len(self._latencies) < self._min_samples:
+            return None
+
+        latencies = sorted(self._latencies)
+
+        return latencies[min(len(latencies) - 1, math.ceil(len(latencies) * self._percentile / 100) - 1)]
+
+def _cookie_to_dict(cookie):
+    cookie_dict = {attr_name: getattr(cookie, attr_name) for attr_name in (
+        'version', 'name', 'value', 'port', 'port_specified', 'domain', 'domain_specified', 'domain_initial_dot',
+        'path', 'path_specified', 'secure', 'expires', 'discard', 'comment', 'comment_url', 'rfc2109')}
+    cookie_dict['rest'] = cookie._rest
+    return cookie_dict
+
+def _to_bytes(v):
+    return v if isinstance(v, bytes) else str(v).encode('utf-8')
+
 class TxDrupalEntityPage(object):
-    def __init__(self, client, entity_type, filters, raw_current_page, prev_page_ref=None, next_page_ref=None):
+    def __init__(self, client, entity_type, filters, raw_current_page, prev_page_ref=None, next_page_ref=None, priority=INTERACTIVE):
         self._client = client
         self._entity_type = entity_type
         self._filters = filters
         self._raw_current_page = raw_current_page
         self._prev_page_ref = prev_page_ref
         self._next_page_ref = next_page_ref
+        self._priority = priority
         self.page_num = int(self._filters.get('page', '0'))
         self._max_page_num = int(parse_qs(urlparse(self._raw_current_page.get('last', '?page=0')).query).get('page', ['0'])[0])
 
+    @property
+    def max_page_num(self):
+        return self._max_page_num
+
     def __len__(self):
         return len(self._raw_current_page.get('list', []))
 
@@ -281,11 +740,11 @@ class TxDrupalEntityPage(object):
         target_page_filters = dict(**self._filters)
         target_page_filters['page'] = str(self.page_num + 1)
 
-        raw_page = yield self._client._get_entities(self._entity_type, target_page_filters)
+        raw_page = yield self._client._get_entities(self._entity_type, target_page_filters, self._priority)
 
         this_page_ref = None if forgetful else self
 
-        target_page_ref = TxDrupalEntityPage(self._client, self._entity_type, target_page_filters, raw_page)
+        target_page_ref = TxDrupalEntityPage(self._client, self._entity_type, target_page_filters, raw_page, priority=self._priority)
 
         setattr(target_page_ref, back_ref_var, this_page_ref)
         setattr(self, page_ref_var, target_page_ref)
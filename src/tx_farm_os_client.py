@@ -1,8 +1,17 @@
 #!/bin/env python3
 
-from twisted.internet import defer
+import logging
 
-from tx_drupal_rest_ws_client import TxDrupalRestWsClient
+from twisted.internet import defer, task
+
+from tx_drupal_rest_ws_client import TxDrupalRestWsClient, TxDrupalRestWsResponseError, DEFAULT_REQUEST_TIMEOUT_SECONDS
+from upstream_scheduler import INTERACTIVE, BULK
+
+# Keeps the urls of list requests filtering by tid reasonably short
+GET_BY_IDS_BATCH_SIZE = 50
+GET_BY_IDS_FALLBACK_PARALLELISM = 8
+# RestWS rejects filters on properties it doesn't know with one of these
+FILTER_UNSUPPORTED_RESPONSE_CODES = (400, 412)
 
 class TxFarmOsClient(object):
     def __init__(self, drupal_client):
@@ -10,8 +19,11 @@ class TxFarmOsClient(object):
         self.area = TxFarmOsAreaClient(drupal_client)
 
     @classmethod
-    def create(cls, farm_os_url, user, password, reactor=None, cookie_jar=None, user_agent="TxFarmOsClient"):
-        drupal_client = TxDrupalRestWsClient.create(drupal_url=farm_os_url, user=user, password=password, reactor=reactor, cookie_jar=cookie_jar, user_agent=user_agent)
+    def create(cls, farm_os_url, user, password, reactor=None, cookie_jar=None, user_agent="TxFarmOsClient", session_store=None, http_cache_size=0,
+               upstream_scheduler=None, request_timeout_seconds=DEFAULT_REQUEST_TIMEOUT_SECONDS, hedging_latency_tracker=None):
+        drupal_client = TxDrupalRestWsClient.create(drupal_url=farm_os_url, user=user, password=password, reactor=reactor, cookie_jar=cookie_jar, user_agent=user_agent,
+                                                    session_store=session_store, http_cache_size=http_cache_size, upstream_scheduler=upstream_scheduler,
+                                                    request_timeout_seconds=request_timeout_seconds, hedging_latency_tracker=hedging_latency_tracker)
 
         return cls(drupal_client)
 
@@ -22,9 +34,12 @@ class TxFarmOsAreaClient(object):
         self._area_vocabulary_id = None
         self._area_vocabulary_id_lock = defer.DeferredLock()
 
+        self._newest_changed_supported = True
+        self._tid_list_filter_supported = True
+
     @defer.inlineCallbacks
-    def get_by_id(self, area_id, validate_type=True):
-        entity = yield self._drupal_client.get_entity(entity_type='taxonomy_term', entity_id=area_id)
+    def get_by_id(self, area_id, validate_type=True, priority=INTERACTIVE):
+        entity = yield self._drupal_client.get_entity(entity_type='taxonomy_term', entity_id=area_id, priority=priority)
 
         if validate_type:
             vid = yield self._get_area_vocabulary_id()
@@ -34,28 +49,130 @@ class TxFarmOsAreaClient(object):
 
         return entity
 
-    def get_all(self):
-        return self._drupal_client.get_all_entities('taxonomy_term', {'bundle': 'farm_areas'})
+    @defer.inlineCallbacks
+    def get_by_ids(self, area_ids, priority=INTERACTIVE):
+        """
+        Returns a Deferred which fires with a list of the farm areas with the given ids - in the order of the ids.
+        Ids which don't identify a farm area are omitted. Areas are fetched in batches with list requests filtering
+        by tid, falling back to fetching them individually with bounded parallelism if FarmOS doesn't support that -
+        in which case failing to get any of the areas fails the whole call.
+        """
+        area_ids = list(dict.fromkeys(str(area_id) for area_id in area_ids))
+
+        vid = yield self._get_area_vocabulary_id()
+
+        entities_by_id = {}
+
+        for batch_start in range(0, len(area_ids), GET_BY_IDS_BATCH_SIZE):
+            batch_area_ids = area_ids[batch_start:batch_start + GET_BY_IDS_BATCH_SIZE]
+
+            batch_entities = None
+
+            if self._tid_list_filter_supported:
+                batch_entities = yield self._get_batch_by_tid_list_filter(batch_area_ids, priority)
+
+            if batch_entities is None:
+                batch_entities = yield self._get_batch_in_parallel(batch_area_ids, priority)
+
+            for entity in batch_entities:
+                entities_by_id[str(entity.get('tid'))] = entity
+
+        return [entities_by_id[area_id] for area_id in area_ids
+                if area_id in entities_by_id and vid == entities_by_id[area_id].get('vocabulary', {}).get('id', None)]
+
+    @defer.inlineCallbacks
+    def _get_batch_by_tid_list_filter(self, batch_area_ids, priority):
+        expected_area_ids = set(batch_area_ids)
+
+        entities = []
+
+        try:
+            page = yield self._drupal_client.get_entities('taxonomy_term', {'bundle': 'farm_areas', 'tid[]': batch_area_ids}, priority)
+
+            while page:
+                # FarmOS ignored the filter so stop before paging through all the areas
+                if any(str(entity.get('tid')) not in expected_area_ids for entity in page):
+                    logging.info("FarmOS doesn't support filtering areas by a list of tids, falling back to fetching them individually")
+                    self._tid_list_filter_supported = False
+                    return None
+
+                entities.extend(page)
+
+                page = yield page.next_page(forgetful=True)
+        except TxDrupalRestWsResponseError as e:
+            if not e.code in FILTER_UNSUPPORTED_RESPONSE_CODES:
+                raise
+
+            logging.info("FarmOS rejected filtering areas by a list of tids ({}), falling back to fetching them individually".format(e.code))
+            self._tid_list_filter_supported = False
+            return None
+
+        return entities
 
     @defer.inlineCallbacks
-    def create(self, record):
+    def _get_batch_in_parallel(self, batch_area_ids, priority):
+        entities = []
+
+        def work_iter():
+            for area_id in batch_area_ids:
+                # The vocabulary is validated once for the whole batch
+                yield self.get_by_id(area_id, validate_type=False, priority=priority).addCallback(entities.append)
+
+        cooperator = task.Cooperator()
+
+        work = work_iter()
+
+        yield defer.gatherResults([cooperator.coiterate(work) for _ignored in range(GET_BY_IDS_FALLBACK_PARALLELISM)], consumeErrors=True)
+
+        return entities
+
+    def get_all(self, priority=INTERACTIVE):
+        return self._drupal_client.get_all_entities('taxonomy_term', {'bundle': 'farm_areas'}, priority)
+
+    @defer.inlineCallbacks
+    def get_newest_changed(self, priority=INTERACTIVE):
+        """
+        Returns a Deferred which fires with a tuple of (number of farm areas, most recently changed farm area) using
+        a single request for a one area page. The area is None if there are no farm areas. Fires with None instead if
+        FarmOS doesn't support limiting the number of areas per page - without asking FarmOS again from then on.
+        """
+        if not self._newest_changed_supported:
+            return None
+
+        page = yield self._drupal_client.get_entities('taxonomy_term', {'bundle': 'farm_areas', 'sort': 'changed', 'direction': 'DESC', 'limit': '1'}, priority)
+
+        # The number of areas is only known from the number of pages if they really only hold one area each
+        if len(page) > 1:
+            logging.info("FarmOS doesn't support limiting the number of areas per page, no longer probing for the most recently changed area")
+            self._newest_changed_supported = False
+            return None
+
+        newest_area = next(iter(page), None)
+
+        return (0 if newest_area is None else page.max_page_num + 1, newest_area)
+
+    @defer.inlineCallbacks
+    def create(self, record, priority=BULK):
         vid = yield self._get_area_vocabulary_id()
 
         entity_record = {}
         entity_record.update(record)
         entity_record['vocabulary'] = vid
 
-        entity = yield self._drupal_client.create_entity('taxonomy_term', entity_record)
+        entity = yield self._drupal_client.create_entity('taxonomy_term', entity_record, priority)
 
         return entity
 
     @defer.inlineCallbacks
-    def update(self, area_id, record):
-        yield self._drupal_client.update_entity('taxonomy_term', area_id, record)
+    def update(self, area_id, record, priority=BULK):
+        yield self._drupal_client.update_entity('taxonomy_term', area_id, record, priority)
 
     @defer.inlineCallbacks
-    def delete(self, area_id):
-        yield self._drupal_client.delete_entity('taxonomy_term', area_id)
+    def delete(self, area_id, priority=BULK):
+        yield self._drupal_client.delete_entity('taxonomy_term', area_id, priority)
+
+    def get_area_vocabulary_id(self):
+        return self._get_area_vocabulary_id()
 
     @defer.inlineCallbacks
     def _get_area_vocabulary_id(self):
@@ -0,0 +1,147 @@
+#!/bin/env python3
+
+from collections import OrderedDict, deque
+from functools import partial
+
+from twisted.internet import defer
+from twisted.python import failure
+
+
+# Priority classes - lower values are started first
+INTERACTIVE = 0
+BACKGROUND = 1
+BULK = 2
+
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background', BULK: 'bulk'}
+
+DEFAULT_MAX_CONCURRENCY = 32
+DEFAULT_MAX_QUEUED = 1024
+DEFAULT_RETRY_AFTER_SECONDS = 5
+
+# Less urgent calls can't take up this share of the queue so there's always room for interactive calls
+INTERACTIVE_RESERVED_QUEUE_FRACTION = 0.25
+
+
+class UpstreamOverloadedError(Exception):
+    """
+    Raised instead of queueing a call when too many calls are already waiting for the upstream server.
+    """
+
+    def __init__(self, retry_after_seconds):
+        super().__init__("Too many requests are waiting for the upstream server. Retry after {} seconds".format(retry_after_seconds))
+
+        self.retry_after_seconds = retry_after_seconds
+
+
+class UpstreamScheduler(object):
+    """
+    Limits the number of concurrent calls to an upstream server across all its users. Waiting calls are started
+    by priority class and - within a class - round-robin between users so that no single user can monopolize the
+    upstream server. Part of the queue is reserved for interactive calls.
+    """
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY, max_queued=DEFAULT_MAX_QUEUED, retry_after_seconds=DEFAULT_RETRY_AFTER_SECONDS):
+        self._max_concurrency = max_concurrency
+        self._max_queued = max_queued
+        self._retry_after_seconds = retry_after_seconds
+
+        self._active = 0
+        self._queued = 0
+
+        # Priority -> user key -> queue of calls. Users are rotated to the end once one of their calls is started.
+        self._queues = {priority: OrderedDict() for priority in (INTERACTIVE, BACKGROUND, BULK)}
+
+    @property
+    def active(self):
+        return self._active
+
+    @property
+    def queued(self):
+        return self._queued
+
+    def run(self, user_key, priority, f, *args, **kwargs):
+        """
+        Returns a Deferred which fires with the result of calling f once a slot is available. The Deferred fails
+        with UpstreamOverloadedError if the call would have to wait in an already full queue. Cancelling it either
+        removes the call from the queue or cancels the Deferred returned by f.
+        """
+        call = _ScheduledCall(user_key, priority, f, args, kwargs)
+
+        call.waiter = defer.Deferred(partial(self._cancel, call))
+
+        if self._active < self._max_concurrency and not self._queued:
+            self._start(call)
+        elif self._queued >= self._queue_limit(priority):
+            return defer.fail(UpstreamOverloadedError(self._retry_after_seconds))
+        else:
+            self._queues[priority].setdefault(user_key, deque()).append(call)
+            self._queued += 1
+
+        return call.waiter
+
+    def _queue_limit(self, priority):
+        if priority == INTERACTIVE:
+            return self._max_queued
+
+        return self._max_queued - max(1, int(self._max_queued * INTERACTIVE_RESERVED_QUEUE_FRACTION))
+
+    def _start(self, call):
+        self._active += 1
+
+        call.running = defer.maybeDeferred(call.f, *call.args, **call.kwargs)
+
+        def complete(result):
+            self._active -= 1
+
+            # The waiter may have already been cancelled
+            if not call.waiter.called:
+                if isinstance(result, failure.Failure):
+                    call.waiter.errback(result)
+                else:
+                    call.waiter.callback(result)
+
+            self._start_queued()
+
+        call.running.addBoth(complete)
+
+    def _start_queued(self):
+        while self._active < self._max_concurrency and self._queued:
+            user_queues = next(queues for queues in self._queues.values() if queues)
+
+            (user_key, user_queue) = next(iter(user_queues.items()))
+
+            call = user_queue.popleft()
+            self._queued -= 1
+
+            if user_queue:
+                user_queues.move_to_end(user_key)
+            else:
+                del user_queues[user_key]
+
+            self._start(call)
+
+    def _cancel(self, call, _waiter):
+        if not call.running is None:
+            call.running.cancel()
+            return
+
+        user_queues = self._queues[call.priority]
+        user_queue = user_queues.get(call.user_key, None)
+
+        if not user_queue is None and call in user_queue:
+            user_queue.remove(call)
+            self._queued -= 1
+
+            if not user_queue:
+                del user_queues[call.user_key]
+
+
+class _ScheduledCall(object):
+    def __init__(self, user_key, priority, f, args, kwargs):
+        self.user_key = user_key
+        self.priority = priority
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.waiter = None
+        self.running = None
@@ -0,0 +1,147 @@
+#!/bin/env python3
+
+import logging
+
+from collections import OrderedDict
+
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_MAX_UNPROVEN_ENTRIES = 8
+
+
+class UserCacheEntry(object):
+    """
+    Data object holding everything cached on behalf of a single user identity.
+    """
+
+    def __init__(self, identity_key, value):
+        self.identity_key = identity_key
+        """Stable key identifying the credentials of the user without revealing them. (required)"""
+
+        self.value = value
+        """Whatever the owner of the registry caches for the user. (required)"""
+
+        self.size = 0
+        """Approximate size in bytes of the cached value."""
+
+        self.proven = False
+        """Whether the credentials of the user have been successfully used. Unproven entries are evicted first."""
+
+        self.pinned = False
+        """Whether this entry is exempt from eviction."""
+
+        self.hits = 0
+        self.misses = 0
+
+
+class UserCacheRegistry(object):
+    """
+    Caches values per user identity with an LRU eviction policy bounded by the approximate total size of the
+    cached values. Entries whose credentials haven't been proven yet - e.g. because of a typo'd password - are
+    limited in number and evicted before any proven entries. If given, release_value is called with the value of
+    each entry which gets evicted or discarded to free anything still referenced from elsewhere.
+    """
+
+    def __init__(self, create_value, max_bytes=DEFAULT_MAX_BYTES, max_unproven_entries=DEFAULT_MAX_UNPROVEN_ENTRIES, release_value=None):
+        self._create_value = create_value
+        self._release_value = release_value
+        self._max_bytes = max_bytes
+        self._max_unproven_entries = max_unproven_entries
+        self._entries = OrderedDict()
+        self._total_size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, identity_key):
+        return identity_key in self._entries
+
+    def get(self, identity_key, *args):
+        """
+        Returns the entry for the given identity key - creating it by calling create_value with the identity key
+        and any additional arguments if it doesn't exist yet.
+        """
+        entry = self._entries.get(identity_key, None)
+
+        if not entry is None:
+            self._entries.move_to_end(identity_key)
+            return entry
+
+        entry = UserCacheEntry(identity_key, self._create_value(identity_key, *args))
+
+        self._entries[identity_key] = entry
+
+        self._evict()
+
+        return entry
+
+    def record_hit(self, entry):
+        entry.hits += 1
+
+    def record_miss(self, entry):
+        entry.misses += 1
+
+    def prove(self, entry):
+        entry.proven = True
+
+    def pin(self, entry):
+        entry.pinned = True
+
+    def update_size(self, entry, size):
+        if self._entries.get(entry.identity_key, None) is entry:
+            self._total_size += size - entry.size
+
+        entry.size = size
+
+        self._evict()
+
+    def discard(self, entry):
+        """
+        Removes the given entry - if it is still registered - e.g. because its credentials turned out to be invalid.
+        """
+        if self._entries.get(entry.identity_key, None) is entry:
+            del self._entries[entry.identity_key]
+            self._total_size -= entry.size
+
+            if not self._release_value is None:
+                self._release_value(entry.value)
+
+    @property
+    def total_size(self):
+        return self._total_size
+
+    def stats(self):
+        """
+        Returns a list of dicts with the hit rate and approximate memory usage of each entry - most recently used last.
+        """
+        return [
+            {
+                'identity': entry.identity_key[:12],
+                'hits': entry.hits,
+                'misses': entry.misses,
+                'hit_rate': entry.hits / (entry.hits + entry.misses) if entry.hits + entry.misses else None,
+                'bytes': entry.size,
+                'proven': entry.proven,
+                'pinned': entry.pinned,
+            } for entry in self._entries.values()
+        ]
+
+    def _evict(self):
+        unproven_entries = [entry for entry in self._entries.values() if not entry.proven and not entry.pinned]
+
+        for entry in unproven_entries[:max(0, len(unproven_entries) - self._max_unproven_entries)]:
+            self._evict_entry(entry)
+
+        while self._total_size > self._max_bytes:
+            entry = next(filter(lambda entry: not entry.proven and not entry.pinned, self._entries.values()), None) \
+                or next(filter(lambda entry: not entry.pinned, self._entries.values()), None)
+
+            if entry is None:
+                return
+
+            self._evict_entry(entry)
+
+    def _evict_entry(self, entry):
+        logging.info("Evicting cached data of user {} ({} bytes)".format(entry.identity_key[:12], entry.size))
+
+        self.discard(entry)
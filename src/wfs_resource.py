@@ -1,6 +1,6 @@
 #!/bin/env python3
 
-import logging
+import re, json, logging
 
 from functools import partial
 from itertools import chain, groupby
@@ -9,7 +9,7 @@ from operator import attrgetter
 from zope.interface import Attribute, Interface, implementer
 
 from twisted.application import service, strports
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.python import log
 from twisted.web import server
 from twisted.web.resource import Resource
@@ -19,12 +19,23 @@ from semantic_version import Version
 from lxml import etree, objectify
 from lxml.builder import E, ElementMaker  # lxml only !
 
-from osgeo import ogr, osr
-
 from deferred_rendering_fn import deferred_rendering_fn
+from deferred_thread_pool import create_thread_pool, run_in_thread_pool, raise_if_cancelled
+from gml_geometry import read_gml2_geometry
+from metrics import wfs_request_seconds, wfs_response_bytes
+from stage_timings import stage_timings
 
 WFS_MIMETYPE = "text/xml"
 
+DEFAULT_SLOW_REQUEST_SECONDS = 10
+
+# Transaction request bodies are parsed incrementally in chunks of this many bytes
+TRANSACTION_READ_CHUNK_SIZE = 64 * 1024
+
+# Matches the EPSG code of srsName values like 'EPSG:3857', 'http://www.opengis.net/gml/srs/epsg.xml#3857', or
+# 'urn:ogc:def:crs:EPSG::3857'
+SRS_NAME_EPSG_CODE_PATTERN = re.compile(r'epsg(?:\.xml#|:(?:[\d.]*:)?)(\d+)$', re.IGNORECASE)
+
 NAMESPACES = {
     'gml': "http://www.opengis.net/gml",
     'ms': "http://mapserver.gis.umn.edu/mapserver",
@@ -101,6 +112,9 @@ class Feature(object):
     Data object holding the data of a single feature.
     """
 
+    # Features are cached in large numbers so keep them compact
+    __slots__ = ('feature_id', 'geometry', 'field_data')
+
     def __init__(self, feature_id, geometry, field_data=None):
         self.feature_id = feature_id
         """Identifier of this feature. (required)"""
@@ -111,8 +125,8 @@ class Feature(object):
         if not field_data:
             field_data = {}
 
-        self.field_data = dict(**field_data)
-        """Field data for this feature. Must be a dictionary containing at least the required fields for a feature of its layer."""
+        self.field_data = field_data
+        """Field data for this feature. Must be a dictionary containing at least the required fields for a feature of its layer. Not copied so it must not be modified afterwards."""
 
 
 class LayerDefinition(object):
@@ -120,13 +134,16 @@ class LayerDefinition(object):
     Data object with the definition of a feature layer.
     """
 
-    def __init__(self, name, default_srs, geometry_type='GeometryPropertyType', title=None, abstract=None, operations=('Query',), fields=(), ext=None):
+    def __init__(self, name, default_srs, geometry_type='GeometryPropertyType', title=None, abstract=None, operations=('Query',), fields=(), ext=None, other_srs=(), lat_long_bounding_box=None):
         self.name = name
         """Name of this feature layer. (required)"""
 
         self.default_srs = default_srs
         """Default spatial reference system of this feature layer. (required)"""
 
+        self.other_srs = tuple(srs for srs in other_srs if srs != default_srs)
+        """Additional spatial reference systems that features of this layer can be requested in. Iterable of strings such as 'EPSG:3857'"""
+
         self.geometry_type = geometry_type
         """Geometry type of this feature layer."""
 
@@ -148,18 +165,42 @@ class LayerDefinition(object):
         self.ext = DictAccessor(dict(**ext))
         """Map of extended properties for this layer accessible via layer_def.ext.my_prop"""
 
+        self.lat_long_bounding_box = lat_long_bounding_box
+        """Extent of the features in this layer as a tuple of (minx, miny, maxx, maxy) in EPSG:4326. None if unknown."""
+
+
+class FeatureQuery(object):
+    """
+    Data object describing how the features of a layer should be returned.
+    """
+
+    def __init__(self, srs=None, bbox=None, simplification_tolerance=None):
+        self.srs = srs
+        """Spatial reference system the feature geometries should be returned in. Either the default spatial reference system of the layer or one of its other spatial reference systems. None for the default spatial reference system."""
+
+        self.bbox = bbox
+        """Tuple of (minx, miny, maxx, maxy) in the requested spatial reference system describing the extent the client is viewing. None if unknown."""
+
+        self.simplification_tolerance = simplification_tolerance
+        """Maximum simplification tolerance in units of the default spatial reference system of the layer that the client accepts. None if the client needs the full geometries."""
+
 
 class UncommittedFeature(object):
     """
     Data object holding the data of a single uncommitted feature.
     """
 
-    def __init__(self, layer_def, geometry, field_data=None, handle=None):
+    __slots__ = ('layer_def', 'geometry', 'srs', 'field_data', 'handle')
+
+    def __init__(self, layer_def, geometry, srs=None, field_data=None, handle=None):
         self.layer_def = layer_def
         """Layer definition for the layer in which the feature should be inserted. (required)"""
 
         self.geometry = geometry
-        """Geometry of this feature. Must be an instance of C{osgeo.ogr.Geometry} with a spatial reference assigned and matching the default spatial reference of its layer. (required)"""
+        """Geometry of this feature. Must be an instance of C{osgeo.ogr.Geometry} or a L{gml_geometry.WktGeometry} in the spatial reference system given by srs. (required)"""
+
+        self.srs = srs or layer_def.default_srs
+        """Spatial reference system of the geometry - the default or one of the other spatial reference systems of its layer."""
 
         if not field_data:
             field_data = {}
@@ -176,7 +217,9 @@ class UncommittedFeatureUpdate(object):
     Data object holding the data of a single uncommitted feature.
     """
 
-    def __init__(self, layer_def, feature_id, geometry=None, field_data=None, handle=None):
+    __slots__ = ('layer_def', 'feature_id', 'geometry', 'srs', 'field_data', 'handle')
+
+    def __init__(self, layer_def, feature_id, geometry=None, srs=None, field_data=None, handle=None):
         self.layer_def = layer_def
         """Layer definition for the layer in which the feature should be updated. (required)"""
 
@@ -184,7 +227,10 @@ class UncommittedFeatureUpdate(object):
         """Identifier of the feature to update. (required)"""
 
         self.geometry = geometry
-        """Updated geometry for this feature. Must be an instance of C{osgeo.ogr.Geometry} with a spatial reference assigned and matching the default spatial reference of its layer. None if the geometry of the feature is not being updated."""
+        """Updated geometry for this feature. Must be an instance of C{osgeo.ogr.Geometry} or a L{gml_geometry.WktGeometry} in the spatial reference system given by srs. None if the geometry of the feature is not being updated."""
+
+        self.srs = srs or layer_def.default_srs
+        """Spatial reference system of the updated geometry - the default or one of the other spatial reference systems of its layer."""
 
         if not field_data:
             field_data = {}
@@ -201,6 +247,8 @@ class UncommittedFeatureDelete(object):
     Data object describing a feature to delete.
     """
 
+    __slots__ = ('layer_def', 'feature_id', 'handle')
+
     def __init__(self, layer_def, feature_id, handle=None):
         self.layer_def = layer_def
         """Layer definition for the layer from which the feature should be deleted. (required)"""
@@ -238,6 +286,8 @@ class CommitOutcomeItem(object):
     associating the handle for that part of the transaction.
     """
 
+    __slots__ = ('data', 'layer_def', 'handle')
+
     def __init__(self, data, layer_def=None, handle=None):
         self.data = data
         """Data of this outcome item. (required)"""
@@ -291,13 +341,27 @@ class IFeatureServer(Interface):
         @type request: C{twisted.web.http.Request}
         """
 
-    def get_all_features(self, layer_def, request):
+    def layer_extents(self, request):
+        """
+        Optional. Returns a dict of layer name to the (minx, miny, maxx, maxy) extent in EPSG:4326 of the features
+        in that layer - superseding the lat_long_bounding_box of its L{LayerDefinition}. Can optionally return a
+        deferred. Only called for GetCapabilities requests so it may be expensive.
+
+        @param request: The request for which the layer extents are being requested.
+        @type request: C{twisted.web.http.Request}
+        """
+
+    def get_all_features(self, layer_def, request, query=None):
         """
         Get all features for a given layer. Can optionally return a deferred.
 
         @param layer_def: The layer to get features for.
         @type layer_def: L{LayerDefinition}
 
+        @param query: How the features should be returned. None to return the features in the default spatial
+           reference system of the layer.
+        @type query: L{FeatureQuery}
+
         @param request: The request for which the features are being retrieved.
            Implementations are expected to avoid parsing anything WFS-related out of the
            request, but may honor headers, authentication state, etc.
@@ -325,10 +389,11 @@ class IFeatureServer(Interface):
 class WfsResource(object):
     isLeaf = False
 
-    def __init__(self, feature_server):
+    def __init__(self, feature_server, thread_pool=None, metrics_resource=None, slow_request_seconds=DEFAULT_SLOW_REQUEST_SECONDS, profiler=None):
         self._feature_server = feature_server
+        self._metrics_resource = metrics_resource
         self._version_specific_resources = (
-            WfsOnePointZeroResource(feature_server),
+            WfsOnePointZeroResource(feature_server, thread_pool=thread_pool, slow_request_seconds=slow_request_seconds, profiler=profiler),
         )
         self._by_version = {r.version : r for r in self._version_specific_resources}
         self._min_version = min(self._by_version.keys())
@@ -338,6 +403,10 @@ class WfsResource(object):
         raise Exception("WfsResource does not support arbitrary child resources.")
 
     def getChildWithDefault(self, name, request):
+        # Metrics are served at their own path rather than as a WFS request
+        if name == b'metrics' and not self._metrics_resource is None:
+            return self._metrics_resource
+
         args = {k.lower(): v for k, v in request.args.items()}
 
         requested_service = _first(args.get(b'service', ()), None)
@@ -381,6 +450,11 @@ class WfsOnePointZeroResource(Resource):
 
             layer_definitions = yield defer.maybeDeferred(feature_server.layer_definitions, request)
 
+            layer_extents = {}
+
+            if hasattr(feature_server, 'layer_extents'):
+                layer_extents = yield defer.maybeDeferred(feature_server.layer_extents, request)
+
             location = request.uri.decode('utf-8')
 
             def request_type(capability_handler):
@@ -400,6 +474,16 @@ class WfsOnePointZeroResource(Resource):
 
                 return [wfs(attr_name.capitalize(), attr)]
 
+            def lat_long_bounding_box_elem(layer_def):
+                lat_long_bounding_box = layer_extents.get(layer_def.name, layer_def.lat_long_bounding_box)
+
+                if lat_long_bounding_box is None:
+                    return ()
+
+                min_x, min_y, max_x, max_y = lat_long_bounding_box
+
+                return [wfs.LatLongBoundingBox(minx=repr(min_x), miny=repr(min_y), maxx=repr(max_x), maxy=repr(max_y))]
+
             return wfs.WFS_Capabilities(
                 wfs.Service(
                  * attr_elem(feature_server, 'name', required=True),
@@ -419,7 +503,8 @@ class WfsOnePointZeroResource(Resource):
                             * attr_elem(layer_def, 'abstract'),
                             wfs.SRS(layer_def.default_srs),
                             wfs.Operations(*[ wfs(operation) for operation in (set(layer_def.operations) & {'Query', 'Insert', 'Update', 'Delete'}) ]),
-                            # TODO: consider providing a mechanism to populate 'LatLongBoundingBox' & 'MetadataURL' elements
+                            * lat_long_bounding_box_elem(layer_def),
+                            # TODO: consider providing a mechanism to populate 'MetadataURL' elements
                         ) for layer_def in layer_definitions ]
                 ),
                 version=str(resource.version)
@@ -491,9 +576,48 @@ class WfsOnePointZeroResource(Resource):
             if not layer_def:
                 raise InvalidWfsRequest("Requested features of an unknown TYPENAME: {!r}".format(requested_type_name))
 
-            features = yield defer.maybeDeferred(resource._feature_server.get_all_features, layer_def, request)
+            requested_srs = _first(args.get(b'srsname', ()), b'').decode('utf-8')
+
+            srs = None
+
+            if requested_srs:
+                srs = next(filter(lambda supported_srs: supported_srs.upper() == requested_srs.upper(), (layer_def.default_srs,) + layer_def.other_srs), None)
+
+                if not srs:
+                    raise InvalidWfsRequest("Requested features of TYPENAME: {!r} in an unsupported SRSNAME: {!r}".format(requested_type_name, requested_srs))
+
+            bbox = None
+
+            requested_bbox = _first(args.get(b'bbox', ()), b'').decode('utf-8')
+
+            if requested_bbox:
+                try:
+                    bbox = tuple(map(float, requested_bbox.split(',')[:4]))
+                except ValueError:
+                    bbox = ()
+
+                if len(bbox) != 4:
+                    raise InvalidWfsRequest("Requested features with an invalid BBOX: {!r}".format(requested_bbox))
+
+            simplification_tolerance = None
+
+            # Non-standard parameter for explicitly requesting simplified geometries
+            requested_simplification_tolerance = _first(args.get(b'simplify', ()), b'').decode('utf-8')
+
+            if requested_simplification_tolerance:
+                try:
+                    simplification_tolerance = float(requested_simplification_tolerance)
+                except ValueError:
+                    raise InvalidWfsRequest("Requested features with an invalid SIMPLIFY tolerance: {!r}".format(requested_simplification_tolerance))
+
+            query = FeatureQuery(srs=srs, bbox=bbox, simplification_tolerance=simplification_tolerance)
+
+            features = yield defer.maybeDeferred(resource._feature_server.get_all_features, layer_def, request, query=query)
 
             def to_feature_member(feature):
+                # Stop building the collection if the client has gone away in the meantime
+                raise_if_cancelled()
+
                 return gml.featureMember(
                     ms(layer_def.name,
                         ms.geometry(
@@ -504,16 +628,22 @@ class WfsOnePointZeroResource(Resource):
                     )
                 )
 
-            return wfs.FeatureCollection(
-                nsAttr.xsi.schemaLocation(("http://mapserver.gis.umn.edu/mapserver "
-                                          +"http://localhost:5707?SERVICE=WFS&VERSION={WFS_PROTOCOL_VERSION}&REQUEST=DescribeFeatureType&TYPENAME={type_name}&OUTPUTFORMAT={WFS_MIMETYPE}; "
-                                          +"subtype={GML_VERSION} http://www.opengis.net/wfs http://schemas.opengis.net/wfs/{WFS_PROTOCOL_VERSION}/wfs.xsd").format(
-                                              WFS_PROTOCOL_VERSION=resource.version,
-                                              WFS_MIMETYPE=WFS_MIMETYPE,
-                                              GML_VERSION=str(resource.gml_version),
-                                              type_name=layer_def.name)),
-                *map(to_feature_member, features)
-            )
+            def build_feature_collection():
+                return wfs.FeatureCollection(
+                    nsAttr.xsi.schemaLocation(("http://mapserver.gis.umn.edu/mapserver "
+                                              +"http://localhost:5707?SERVICE=WFS&VERSION={WFS_PROTOCOL_VERSION}&REQUEST=DescribeFeatureType&TYPENAME={type_name}&OUTPUTFORMAT={WFS_MIMETYPE}; "
+                                              +"subtype={GML_VERSION} http://www.opengis.net/wfs http://schemas.opengis.net/wfs/{WFS_PROTOCOL_VERSION}/wfs.xsd").format(
+                                                  WFS_PROTOCOL_VERSION=resource.version,
+                                                  WFS_MIMETYPE=WFS_MIMETYPE,
+                                                  GML_VERSION=str(resource.gml_version),
+                                                  type_name=layer_def.name)),
+                    *map(to_feature_member, features)
+                )
+
+            with stage_timings(request).stage('build'):
+                feature_collection = yield run_in_thread_pool(resource._thread_pool, build_feature_collection)
+
+            return feature_collection
 
     class TransactionCapabilityHandler(object):
         capability = b'Transaction'
@@ -527,14 +657,6 @@ class WfsOnePointZeroResource(Resource):
 
             layer_definitions = yield defer.maybeDeferred(resource._feature_server.layer_definitions, request)
 
-            wfs_transaction = objectify.parse(request.content).getroot()
-
-            if logging.getLogger().isEnabledFor(logging.DEBUG):
-                logging.debug(etree.tostring(wfs_transaction, pretty_print=True).decode('utf-8'))
-
-            if wfs_transaction.tag != nsTag.wfs.Transaction:
-                raise Exception("Unsupported post request body root: " + wfs_transaction.tag)
-
             features_to_insert = []
             features_to_update = []
             features_to_delete = []
@@ -559,13 +681,18 @@ class WfsOnePointZeroResource(Resource):
                     wfs_read_transaction_failures.append(CommitOutcomeItem(layer_def=layer_def, handle=handle, data="Received invalid feature to insert with {} geometries".format(len(geos))))
                     return
 
+                srs = _read_geometry_srs(geos[0], layer_def)
+
+                if not srs:
+                    wfs_read_transaction_failures.append(CommitOutcomeItem(layer_def=layer_def, handle=handle, data="Received feature to insert in an unsupported srsName: {!r}".format(geos[0].get('srsName'))))
+                    return
+
                 try:
-                    geometry = ogr.CreateGeometryFromGML(etree.tostring(geos[0]).decode("utf-8"))
+                    geometry = read_gml2_geometry(geos[0])
                 except:
                     formatted_exception = logging.traceback.format_exc()
                     wfs_read_transaction_failures.append(CommitOutcomeItem(layer_def=layer_def, handle=handle, data="Received invalid feature to insert with unreadable geometry: " + formatted_exception))
-
-                # TODO: Validate/normalize srs
+                    return
 
                 missing_required_field_names = []
 
@@ -587,7 +714,7 @@ class WfsOnePointZeroResource(Resource):
                     wfs_read_transaction_failures.append(CommitOutcomeItem(layer_def=layer_def, handle=handle, data="Received invalid feature to insert with missing required fields: {}".format(missing_required_field_names)))
                     return
 
-                features_to_insert.append(UncommittedFeature(layer_def=layer_def, geometry=geometry, field_data=field_data, handle=handle))
+                features_to_insert.append(UncommittedFeature(layer_def=layer_def, geometry=geometry, srs=srs, field_data=field_data, handle=handle))
 
             def read_update(handle, action):
                 type_name = etree.QName(action.get('typeName', '')).localname
@@ -603,6 +730,7 @@ class WfsOnePointZeroResource(Resource):
                     return
 
                 geometry = None
+                srs = None
                 field_data = {}
 
                 fields_by_name = {field.name: field for field in layer_def.fields}
@@ -617,13 +745,18 @@ class WfsOnePointZeroResource(Resource):
                             wfs_read_transaction_failures.append(CommitOutcomeItem(layer_def=layer_def, handle=handle, data="Received invalid feature update with {} geometries".format(len(geos))))
                             return
 
+                        srs = _read_geometry_srs(geos[0], layer_def)
+
+                        if not srs:
+                            wfs_read_transaction_failures.append(CommitOutcomeItem(layer_def=layer_def, handle=handle, data="Received feature update in an unsupported srsName: {!r}".format(geos[0].get('srsName'))))
+                            return
+
                         try:
-                            geometry = ogr.CreateGeometryFromGML(etree.tostring(geos[0]).decode("utf-8"))
+                            geometry = read_gml2_geometry(geos[0])
                         except:
                             formatted_exception = logging.traceback.format_exc()
                             wfs_read_transaction_failures.append(CommitOutcomeItem(layer_def=layer_def, handle=handle, data="Received invalid feature update unreadable geometry: " + formatted_exception))
-
-                        # TODO: Validate/normalize srs
+                            return
                     else:
                         field = fields_by_name.get(property_name, None)
 
@@ -641,7 +774,7 @@ class WfsOnePointZeroResource(Resource):
 
                             feature_id = update_filter.get('fid')
 
-                            features_to_update.append(UncommittedFeatureUpdate(layer_def=layer_def, feature_id=feature_id, geometry=geometry, field_data=field_data, handle=handle))
+                            features_to_update.append(UncommittedFeatureUpdate(layer_def=layer_def, feature_id=feature_id, geometry=geometry, srs=srs, field_data=field_data, handle=handle))
 
             def read_delete(handle, action):
                 type_name = etree.QName(action.get('typeName', '')).localname
@@ -668,7 +801,9 @@ class WfsOnePointZeroResource(Resource):
 
                     features_to_delete.append(UncommittedFeatureDelete(layer_def=layer_def, feature_id=feature_id))
 
-            for action in wfs_transaction.iterchildren():
+            def read_action(action):
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug(etree.tostring(action, pretty_print=True).decode('utf-8'))
 
                 handle = action.get('handle', None)
 
@@ -685,6 +820,51 @@ class WfsOnePointZeroResource(Resource):
                 else:
                     wfs_read_transaction_failures.append(CommitOutcomeItem(handle=handle, data="Received unknown operation type: ".format(action.tag)))
 
+            # Actions are read one at a time - with the same element classes objectify.parse would give them - and
+            # discarded once read so that large transactions never need to be held in memory as a whole tree
+            transaction_parser = etree.XMLPullParser(events=('start', 'end'), remove_blank_text=True)
+            transaction_parser.set_element_class_lookup(objectify.ObjectifyElementClassLookup())
+
+            depth = 0
+
+            # Parsing the request body and its geometries is CPU-bound so keep it off the reactor thread
+            def read_transaction_chunk():
+                nonlocal depth
+
+                chunk = request.content.read(TRANSACTION_READ_CHUNK_SIZE)
+
+                if chunk:
+                    transaction_parser.feed(chunk)
+                else:
+                    transaction_parser.close()
+
+                for (event, element) in transaction_parser.read_events():
+                    if event == 'start':
+                        depth += 1
+
+                        if depth == 1 and element.tag != nsTag.wfs.Transaction:
+                            raise Exception("Unsupported post request body root: " + element.tag)
+
+                        continue
+
+                    depth -= 1
+
+                    if depth == 1:
+                        read_action(element)
+
+                        element.clear()
+                        while not element.getprevious() is None:
+                            element.getparent().remove(element.getprevious())
+
+                return bool(chunk)
+
+            more_to_read = True
+
+            # The whole body is read - and must be well-formed - before anything is committed, so malformed requests
+            # never leave behind partially committed transactions
+            while more_to_read:
+                with stage_timings(request).stage('read'):
+                    more_to_read = yield run_in_thread_pool(resource._transaction_thread_pool, read_transaction_chunk)
 
             transaction = Transaction(features_to_insert=features_to_insert,
                                       features_to_update=features_to_update,
@@ -727,8 +907,17 @@ class WfsOnePointZeroResource(Resource):
                 version=str(resource.version)
             )
 
-    def __init__(self, feature_server):
+    def __init__(self, feature_server, thread_pool=None, slow_request_seconds=DEFAULT_SLOW_REQUEST_SECONDS, profiler=None):
         self._feature_server = feature_server
+        self._thread_pool = thread_pool
+        # Requests taking longer than this are logged with a breakdown of where the time went. Disabled when falsy
+        self._slow_request_seconds = slow_request_seconds
+        # Running profiles of the proxy may be limited to a number of requests
+        self._profiler = profiler
+        # libxml2 doesn't cope with an incremental parser being fed from different threads so all Transaction
+        # parsing happens on a single dedicated thread
+        self._transaction_thread_pool = None if thread_pool is None else \
+            create_thread_pool(reactor, size=1, name="FarmOsAreaFeatureProxyTransactionReader")
         self._capability_handlers = { capability_handler.capability : capability_handler for capability_handler in (
             self.GetCapabilitiesCapabilityHandler(),
             self.DescribeFeatureTypeCapabilityHandler(),
@@ -742,6 +931,9 @@ class WfsOnePointZeroResource(Resource):
         # Make sure this fn is always a generator
         yield defer.succeed(True)
 
+        # Stages of handling the request - here and in the feature server - are timed via the request
+        timings = stage_timings(request)
+
         args = {k.lower(): v for k, v in request.args.items()}
 
         # Assume POST requests should go through the Transaction capability handler
@@ -761,12 +953,63 @@ class WfsOnePointZeroResource(Resource):
             if not request.method.decode('utf-8').lower().capitalize() in capability_handler.methods:
                 raise InvalidWfsRequest("Capability: {!r} not supported via HTTP method: {!r}".format(request_type, request.method))
 
-        response_doc = yield capability_handler.handle(self, request, args)
+        capability = capability_handler.capability.decode('utf-8')
+
+        response_body = None
+        try:
+            response_doc = yield capability_handler.handle(self, request, args)
+
+            def serialize_response_doc():
+                etree.cleanup_namespaces(response_doc)
+                return etree.tostring(response_doc, pretty_print=True)
+
+            with timings.stage('serialize'):
+                response_body = yield run_in_thread_pool(self._thread_pool, serialize_response_doc)
+        finally:
+            total_seconds = timings.total_seconds()
+
+            wfs_request_seconds.observe(total_seconds, capability=capability)
+
+            request.setHeader('Server-Timing', timings.server_timing_header())
+
+            if self._slow_request_seconds and total_seconds > self._slow_request_seconds:
+                logging.warning("Slow request: " + json.dumps({
+                    'method': request.method.decode('utf-8'),
+                    'uri': request.uri.decode('utf-8'),
+                    'capability': capability,
+                    'succeeded': not response_body is None,
+                    'response_bytes': None if response_body is None else len(response_body),
+                    'stage_ms': {name: round(seconds * 1000, 1) for (name, seconds) in timings.durations()},
+                }))
+
+            if not self._profiler is None:
+                self._profiler.request_finished()
+
+        wfs_response_bytes.observe(len(response_body), capability=capability)
 
         request.setHeader('Content-Type', WFS_MIMETYPE)
         request.setResponseCode(code=200)
-        etree.cleanup_namespaces(response_doc)
-        return etree.tostring(response_doc, pretty_print=True)
+        return response_body
+
+
+def _read_geometry_srs(element, layer_def):
+    """
+    Returns the spatial reference system of the given layer named by the srsName of the given GML geometry element
+    - the default one of the layer if there is no srsName - or None if the layer doesn't support it.
+    """
+    srs_name = element.get('srsName', '').strip()
+
+    if not srs_name:
+        return layer_def.default_srs
+
+    match = SRS_NAME_EPSG_CODE_PATTERN.search(srs_name)
+
+    if match is None:
+        return None
+
+    srs = 'EPSG:' + match.group(1)
+
+    return next(filter(lambda layer_srs: layer_srs.upper() == srs, (layer_def.default_srs,) + layer_def.other_srs), None)
 
 
 def _first(iterable, default):
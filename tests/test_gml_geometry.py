@@ -0,0 +1,85 @@
+#!/bin/env python3
+
+import os, sys, unittest
+
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+try:
+    from osgeo import ogr
+except ImportError:
+    ogr = None
+
+
+GML_NAMESPACE_DECLARATION = 'xmlns:gml="http://www.opengis.net/gml"'
+
+# GML2 geometries which the fast path reads itself
+SIMPLE_GML2_GEOMETRIES = (
+    '<gml:Point {}><gml:coordinates>1.5,-2</gml:coordinates></gml:Point>',
+    '<gml:Point {}><gml:coordinates>1.5,-2,3.25</gml:coordinates></gml:Point>',
+    '<gml:Point {}><gml:coordinates decimal="," cs=";" ts="|">1,5;2</gml:coordinates></gml:Point>',
+    '<gml:LineString {}><gml:coordinates>0,0 1e3,2.5\n 3,.5</gml:coordinates></gml:LineString>',
+    '<gml:LineString {}><gml:coordinates cs=" " ts=",">0 0 1,1 1 2</gml:coordinates></gml:LineString>',
+    '<gml:Polygon {}><gml:outerBoundaryIs><gml:LinearRing><gml:coordinates>0,0 4,0 4,4 0,4 0,0</gml:coordinates></gml:LinearRing></gml:outerBoundaryIs></gml:Polygon>',
+    '<gml:Polygon {}><gml:outerBoundaryIs><gml:LinearRing><gml:coordinates>0,0 4,0 4,4 0,4 0,0</gml:coordinates></gml:LinearRing></gml:outerBoundaryIs>'
+    '<gml:innerBoundaryIs><gml:LinearRing><gml:coordinates>1,1 2,1 2,2 1,1</gml:coordinates></gml:LinearRing></gml:innerBoundaryIs></gml:Polygon>',
+    '<gml:Polygon {}><gml:outerBoundaryIs><gml:LinearRing><gml:coordinates>0,0,1 4,0,1 4,4,2 0,0,1</gml:coordinates></gml:LinearRing></gml:outerBoundaryIs>'
+    '<gml:innerBoundaryIs><gml:LinearRing><gml:coordinates>1,1,1 2,1,1 2,2,1 1,1,1</gml:coordinates></gml:LinearRing></gml:innerBoundaryIs></gml:Polygon>',
+)
+
+# GML2 geometries which the fast path leaves to OGR
+OTHER_GML2_GEOMETRIES = (
+    '<gml:Polygon {}><gml:outerBoundaryIs><gml:LinearRing><gml:coordinates>0,0 4,0 4,4 0,4 0,0</gml:coordinates></gml:LinearRing></gml:outerBoundaryIs>'
+    '<gml:innerBoundaryIs><gml:LinearRing><gml:coordinates>1,1,1 2,1,1 2,2,1 1,1,1</gml:coordinates></gml:LinearRing></gml:innerBoundaryIs></gml:Polygon>',
+    '<gml:Polygon {}><gml:outerBoundaryIs><gml:LinearRing><gml:coordinates>0,0,1 4,0,1 4,4,2 0,0,1</gml:coordinates></gml:LinearRing></gml:outerBoundaryIs>'
+    '<gml:innerBoundaryIs><gml:LinearRing><gml:coordinates>1,1 2,1 2,2 1,1</gml:coordinates></gml:LinearRing></gml:innerBoundaryIs></gml:Polygon>',
+    '<gml:Point {}><gml:coord><gml:X>1</gml:X><gml:Y>2</gml:Y></gml:coord></gml:Point>',
+)
+
+
+def _parse(gml):
+    return etree.fromstring(gml.format(GML_NAMESPACE_DECLARATION))
+
+
+@unittest.skipIf(ogr is None, "GDAL's Python bindings aren't installed")
+class ReadGml2GeometryTest(unittest.TestCase):
+    """
+    Checks that geometries read by the fast path of read_gml2_geometry match those read by OGR.
+    """
+
+    def test_simple_geometries_match_ogr(self):
+        from gml_geometry import WktGeometry, read_gml2_geometry
+
+        for gml in SIMPLE_GML2_GEOMETRIES:
+            with self.subTest(gml=gml):
+                geometry = read_gml2_geometry(_parse(gml))
+
+                self.assertIsInstance(geometry, WktGeometry)
+
+                self._assert_matches_ogr(geometry, gml)
+
+    def test_other_geometries_are_read_by_ogr(self):
+        from gml_geometry import WktGeometry, read_gml2_geometry
+
+        for gml in OTHER_GML2_GEOMETRIES:
+            with self.subTest(gml=gml):
+                geometry = read_gml2_geometry(_parse(gml))
+
+                self.assertNotIsInstance(geometry, WktGeometry)
+
+                self._assert_matches_ogr(geometry, gml)
+
+    def _assert_matches_ogr(self, geometry, gml):
+        expected_geometry = ogr.CreateGeometryFromGML(etree.tostring(_parse(gml)).decode("utf-8"))
+
+        actual_geometry = ogr.CreateGeometryFromWkt(geometry.ExportToWkt())
+
+        self.assertIsNotNone(actual_geometry, geometry.ExportToWkt())
+        self.assertEqual(actual_geometry.GetGeometryType(), expected_geometry.GetGeometryType())
+        self.assertEqual(actual_geometry.ExportToIsoWkt(), expected_geometry.ExportToIsoWkt())
+        self.assertEqual(geometry.GetEnvelope(), expected_geometry.GetEnvelope())
+
+
+if __name__ == '__main__':
+    unittest.main()